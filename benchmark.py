@@ -0,0 +1,159 @@
+'''
+Measures how the AIs' parallel modes scale with the number of worker
+processes, and how much minimax's pruning saves, on a few fixed positions.
+
+MCTS: rollouts per second with root- or leaf-parallel workers (--mcts-workers
+and --mcts-parallel in chess.py)
+Minimax: time to finish a search to a fixed depth with Lazy SMP helpers
+(--minimax-threads in chess.py)
+Pruning: minimax's nodes and time to a fixed depth with and without null-move
+pruning and late move reductions (--minimax-null-move and --minimax-lmr)
+Table: minimax's nodes and time to each depth with and without a transposition
+table (--minimax-hash), for a fresh search and for the same search repeated
+'''
+
+import argparse
+import random
+import time
+
+import board
+from mcts import MCTS, Tree
+from minimax import Minimax
+
+def get_positions(variant, n_positions, seed=0):
+    ''' Returns the starting position followed by positions reached by playing
+    random moves from it, the same ones on every run, along with each one's
+    side to move and game history'''
+    rng = random.Random(seed)
+    positions = []
+    for i in range(n_positions):
+        chessboard = board.set_board(variant)
+        pos_counts = board.GameState()
+        pos_counts.push(chessboard)
+        side = 1
+        for ply in range(10*i):
+            moves = board.get_all_moves(chessboard, side)
+            if board.get_result(chessboard, pos_counts, variant, -side, False, moves) is not None:
+                break
+            chessboard = board.make_move(chessboard, *rng.choice(moves))
+            pos_counts.push(chessboard)
+            side *= -1
+        positions.append((chessboard, side, pos_counts))
+    return positions
+
+def bench_mcts(args, positions):
+    print('workers  rollouts/sec  speedup')
+    base_rate = None
+    for workers in args.workers:
+        rollouts = 0
+        elapsed = 0
+        for chessboard, side, pos_counts in positions:
+            agent = MCTS(side, args.mcts_depth, args.mcts_rollouts, args.variant, False, None, None, 0.5, args.backend, False, workers, args.mcts_parallel)
+            agent.tree = Tree(chessboard)
+            agent.cur_board = chessboard
+            # The first search also starts the worker processes, so it isn't timed
+            agent.get_move(chessboard, pos_counts)
+            then = time.time()
+            agent.get_move(chessboard, pos_counts)
+            elapsed += time.time() - then
+            rollouts += args.mcts_rollouts
+            if agent.pool:
+                agent.pool.close()
+            if agent.executor:
+                agent.executor.shutdown()
+        rate = rollouts/elapsed
+        base_rate = base_rate or rate
+        print('{:7d}  {:12.1f}  {:7.2f}'.format(workers, rate, rate/base_rate))
+
+def bench_minimax(args, positions):
+    print('workers  seconds to depth {}  nodes (main + helpers)  speedup'.format(args.minimax_depth))
+    base_elapsed = None
+    for workers in args.workers:
+        elapsed = 0
+        nodes = 0
+        for chessboard, side, pos_counts in positions:
+            agent = Minimax(side, 1, args.variant, args.backend, args.minimax_hash, 0, 0, False, workers)
+            # The first search also starts the helper processes, so it isn't
+            # timed, and what it put in the table is cleared
+            agent.get_move(chessboard, pos_counts)
+            if agent.table is not None:
+                agent.table.clear()
+            agent.depth = args.minimax_depth
+            then = time.time()
+            agent.get_move(chessboard, pos_counts)
+            elapsed += time.time() - then
+            nodes += agent.nodes + agent.helper_nodes
+            if agent.pool:
+                agent.pool.close()
+        base_elapsed = base_elapsed or elapsed
+        print('{:7d}  {:18.2f}  {:22d}  {:7.2f}'.format(workers, elapsed, nodes, base_elapsed/elapsed))
+
+def bench_pruning(args, positions):
+    print('null move  lmr    nodes to depth {}  seconds'.format(args.minimax_depth))
+    for null_move, lmr in ((False, False), (True, False), (False, True), (True, True)):
+        nodes = 0
+        elapsed = 0
+        for chessboard, side, pos_counts in positions:
+            agent = Minimax(side, args.minimax_depth, args.variant, args.backend, args.minimax_hash, 0, 0, False, 1, 'smp', False, null_move, lmr)
+            then = time.time()
+            agent.get_move(chessboard, pos_counts)
+            elapsed += time.time() - then
+            nodes += agent.nodes
+        print('{:9}  {:5}  {:17d}  {:7.2f}'.format(str(null_move), str(lmr), nodes, elapsed))
+
+def bench_table(args, positions):
+    print('depth  table MB  fresh nodes  seconds  repeated nodes')
+    for depth in range(2, args.minimax_depth + 1):
+        for hash_mb in (0, args.minimax_hash):
+            nodes = 0
+            elapsed = 0
+            repeated = 0
+            for chessboard, side, pos_counts in positions:
+                agent = Minimax(side, depth, args.variant, args.backend, hash_mb, 0, 0, False, 1, 'smp', False)
+                then = time.time()
+                agent.get_move(chessboard, pos_counts)
+                elapsed += time.time() - then
+                nodes += agent.nodes
+                # Searching again, the table already holds the whole tree
+                agent.get_move(chessboard, pos_counts)
+                repeated += agent.nodes
+            print('{:5d}  {:8g}  {:11d}  {:7.2f}  {:14d}'.format(depth, hash_mb, nodes, elapsed, repeated))
+
+def parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--bench', type=str, nargs='+', default=['mcts', 'minimax', 'pruning', 'table'],
+                        choices=['mcts', 'minimax', 'pruning', 'table'],
+                        help='which benchmarks to run')
+    parser.add_argument('--backend', type=str, default='array',
+                        choices=list(board.BACKENDS),
+                        help='board representation used by AI move generation')
+    parser.add_argument('--mcts-depth', type=int, default=20,
+                        help='MCTS max rollout depth (0 for unlimited)')
+    parser.add_argument('--mcts-parallel', type=str, default='root',
+                        choices=['root', 'leaf'],
+                        help='how MCTS uses more than one worker')
+    parser.add_argument('--mcts-rollouts', type=int, default=200,
+                        help='number of MCTS rollouts per search')
+    parser.add_argument('--minimax-depth', type=int, default=4,
+                        help='depth that minimax searches to')
+    parser.add_argument('--minimax-hash', type=float, default=16,
+                        help='minimax transposition table size in MB')
+    parser.add_argument('--positions', type=int, default=3,
+                        help='number of fixed positions to search')
+    parser.add_argument('--variant', type=str, default='normal',
+                        help='type of chess to play')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='numbers of worker processes to compare')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    positions = get_positions(args.variant, args.positions)
+    if 'mcts' in args.bench:
+        bench_mcts(args, positions)
+    if 'minimax' in args.bench:
+        bench_minimax(args, positions)
+    if 'pruning' in args.bench:
+        bench_pruning(args, positions)
+    if 'table' in args.bench:
+        bench_table(args, positions)
@@ -4,7 +4,10 @@ Date: November 23, 2019
 Stores functions and constants relating to the chess board.
 '''
 
-import numpy as np
+import random
+from collections import defaultdict
+
+import heuristic
 
 EMPTY=0
 WHITE_PAWN=1
@@ -27,8 +30,99 @@ EP_ROW_DIGIT = 66
 EP_COL_DIGIT = 67
 
 NUM_PIECES = 13
+NUM_DIGITS = 68
+
+class Board(object):
+    ''' A chess position stored as one byte per digit of the old base-13
+    encoding (see set_board()): bytes 0-63 are the squares, counting
+    horizontally from the upper left, and bytes 64-67 are the castling rights
+    and en passant square. Boards are treated as immutable values; make_move()
+    always returns a new Board, and only play_move() changes one in place.
+    Each board carries its Zobrist key, which is what repetition counts
+    (pos_counts) and other caches are keyed on, and its material and
+    piece-square score (see heuristic.PIECE_SQUARE). Both are updated
+    incrementally by make_move(). halfmove is the number of moves
+    since the last capture or pawn move, which isn't part of the position
+    (and so isn't compared or hashed). The bitboards for a board are computed
+    the first time they're needed (see get_bitboards()).'''
+    __slots__ = ('squares', 'key', 'score', 'halfmove', 'bitboards')
+
+    def __init__(self, squares, key=None, score=None, halfmove=0):
+        self.squares = squares
+        self.key = compute_key(squares) if key is None else key
+        self.score = compute_score(squares) if score is None else score
+        self.halfmove = halfmove
+        self.bitboards = None
+
+    def __eq__(self, other):
+        return isinstance(other, Board) and self.squares == other.squares
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self.key
+
+    def __getstate__(self):
+        return (bytes(self.squares), self.halfmove)
+
+    def __setstate__(self, state):
+        # Boards pickled before the halfmove clock was added are just bytes
+        if isinstance(state, bytes):
+            state = (state, 0)
+        self.squares = bytearray(state[0])
+        self.key = compute_key(self.squares)
+        self.score = compute_score(self.squares)
+        self.halfmove = state[1]
+        self.bitboards = None
+
+# Zobrist hashing: ZOBRIST[digit][value] is a random 64-bit number for every
+# value each digit of a board can take, and a board's key is the XOR of the
+# numbers for its digits. Empty squares, no castling rights and no en passant
+# square contribute nothing. Seeded so that keys are the same in every process.
+_zobrist_random = random.Random(20191123)
+ZOBRIST = [[_zobrist_random.getrandbits(64) for value in range(NUM_PIECES)] for digit in range(NUM_DIGITS)]
+for digit in range(64):
+    ZOBRIST[digit][EMPTY] = 0
+ZOBRIST[WHITE_CASTLE_DIGIT][0] = 0
+ZOBRIST[BLACK_CASTLE_DIGIT][0] = 0
+ZOBRIST[EP_ROW_DIGIT][8] = 0
+ZOBRIST[EP_COL_DIGIT][8] = 0
+
+# Boards don't record whose move it is, so searches that need to tell the two
+# apart (e.g. transposition tables) XOR this into the key when Black is to move
+ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+
+# If set, make_move() checks every incrementally updated key and score against
+# ones computed from scratch
+DEBUG_INCREMENTAL = False
+
+def compute_key(squares):
+    key = 0
+    for digit in range(NUM_DIGITS):
+        key ^= ZOBRIST[digit][squares[digit]]
+    return key
+
+def compute_score(squares):
+    piece_square = heuristic.PIECE_SQUARE
+    score = 0.0
+    for square in range(64):
+        score += piece_square[squares[square]][square]
+    return score
+
+def from_int(n):
+    ''' Converts a board in the old base-13 integer encoding to a Board'''
+    squares = bytearray(NUM_DIGITS)
+    for i in range(NUM_DIGITS):
+        n, squares[i] = divmod(n, NUM_PIECES)
+    return Board(squares)
 
-POWERS = np.array([NUM_PIECES**n for n in range(70)])
+def to_int(board):
+    ''' Converts a Board to the old base-13 integer encoding'''
+    n = 0
+    for i in reversed(range(NUM_DIGITS)):
+        n = n*NUM_PIECES + board.squares[i]
+    return n
 
 def set_board(variant='normal'):
     ''' Represented digitally: each square is a place, counting horizontally
@@ -37,148 +131,115 @@ def set_board(variant='normal'):
     (0 for neither side, 1 for kingside only, 2 for queenside only, 3 for both)
     66th and 67th digits are row and col, respectively, for the square with
     legal en passant, if any; they're set to 8 if there is no such square
-    If n is number of pieces:
+    Each digit is stored as one byte of a Board (see from_int() and to_int()
+    for the equivalent base-13 integer, which is how boards used to be stored):
     board = ep_col * n^67 + ep_col * n^66
     +
     black_castle_rights * n^65 + white_castle_rights * n^64
     +
     sum from i=0 to 63 of piece_i * n^i
     '''
-    board = 0
+    squares = bytearray(NUM_DIGITS)
     if variant == 'normal':
         # Pawns
         for col in range(8):
-            place = 1*8 + col
-            board += BLACK_PAWN*POWERS[place]
-            place = 6*8 + col
-            board += WHITE_PAWN*POWERS[place]
+            squares[1*8 + col] = BLACK_PAWN
+            squares[6*8 + col] = WHITE_PAWN
         # Knights
         for col in (1, 6):
-            place = 0*8 + col
-            board += BLACK_KNIGHT*POWERS[place]
-            place = 7*8 + col
-            board += WHITE_KNIGHT*POWERS[place]
+            squares[0*8 + col] = BLACK_KNIGHT
+            squares[7*8 + col] = WHITE_KNIGHT
         # Bishops
         for col in (2, 5):
-            place = 0*8 + col
-            board += BLACK_BISHOP*POWERS[place]
-            place = 7*8 + col
-            board += WHITE_BISHOP*POWERS[place]
+            squares[0*8 + col] = BLACK_BISHOP
+            squares[7*8 + col] = WHITE_BISHOP
         # Rooks
         for col in (0, 7):
-            place = 0*8 + col
-            board += BLACK_ROOK*POWERS[place]
-            place = 7*8 + col
-            board += WHITE_ROOK*POWERS[place]
+            squares[0*8 + col] = BLACK_ROOK
+            squares[7*8 + col] = WHITE_ROOK
         # Queens
-        place = 0*8 + 3
-        board += BLACK_QUEEN*POWERS[place]
-        place = 7*8 + 3
-        board += WHITE_QUEEN*POWERS[place]
-
+        squares[0*8 + 3] = BLACK_QUEEN
+        squares[7*8 + 3] = WHITE_QUEEN
         # Kings
-        place = 0*8 + 4
-        board += BLACK_KING*POWERS[place]
-        place = 7*8 + 4
-        board += WHITE_KING*POWERS[place]
+        squares[0*8 + 4] = BLACK_KING
+        squares[7*8 + 4] = WHITE_KING
         # Castling: both sides start at 3, i.e. can castle either side
-        board += 3*POWERS[WHITE_CASTLE_DIGIT]
-        board += 3*POWERS[BLACK_CASTLE_DIGIT]
+        squares[WHITE_CASTLE_DIGIT] = 3
+        squares[BLACK_CASTLE_DIGIT] = 3
     elif variant == 'horde':
         # Pawns
         for col in range(8):
-            place = 1*8 + col
-            board += BLACK_PAWN*POWERS[place]
+            squares[1*8 + col] = BLACK_PAWN
         # Knights
         for col in (1, 6):
-            place = 0*8 + col
-            board += BLACK_KNIGHT*POWERS[place]
+            squares[0*8 + col] = BLACK_KNIGHT
         # Bishops
         for col in (2, 5):
-            place = 0*8 + col
-            board += BLACK_BISHOP*POWERS[place]
+            squares[0*8 + col] = BLACK_BISHOP
         # Rooks
         for col in (0, 7):
-            place = 0*8 + col
-            board += BLACK_ROOK*POWERS[place]
+            squares[0*8 + col] = BLACK_ROOK
         # Queens
-        place = 0*8 + 3
-        board += BLACK_QUEEN*POWERS[place]
+        squares[0*8 + 3] = BLACK_QUEEN
         # Kings
-        place = 0*8 + 4
-        board += BLACK_KING*POWERS[place]
+        squares[0*8 + 4] = BLACK_KING
         # White pawns
         for row in range(4, 8):
             for col in range(8):
-                place = row*8 + col
-                board += WHITE_PAWN*POWERS[place]
+                squares[row*8 + col] = WHITE_PAWN
         for col in (1, 2, 5, 6):
-            place = 3*8 + col
-            board += WHITE_PAWN*POWERS[place]
+            squares[3*8 + col] = WHITE_PAWN
         # Castling: Only black can castle (not that it matters)
-        board += 3*POWERS[BLACK_CASTLE_DIGIT]
+        squares[BLACK_CASTLE_DIGIT] = 3
     elif variant == 'test':
-        place = 3*8 + 3
-        board += BLACK_PAWN*POWERS[place]
-        place = 6*8 + 4
-        board += WHITE_PAWN*POWERS[place]
-        place = 0*8 + 3
-        board += BLACK_KING*POWERS[place]
-        place = 7*8 + 4
-        board += WHITE_KING*POWERS[place]
+        squares[3*8 + 3] = BLACK_PAWN
+        squares[6*8 + 4] = WHITE_PAWN
+        squares[0*8 + 3] = BLACK_KING
+        squares[7*8 + 4] = WHITE_KING
         # No castling
     # En passant initialized to nonexistent, i.e. row, col = 8, 8
-    place = 66
-    board += 8*POWERS[EP_ROW_DIGIT]
-    place = 67
-    board += 8*POWERS[EP_COL_DIGIT]
-    return board
+    squares[EP_ROW_DIGIT] = 8
+    squares[EP_COL_DIGIT] = 8
+    return Board(squares)
 
 def get_ep_square(board):
-    row = (board // POWERS[EP_ROW_DIGIT]) % NUM_PIECES
-    col = (board // POWERS[EP_COL_DIGIT]) % NUM_PIECES
-    return (row, col)
+    return (board.squares[EP_ROW_DIGIT], board.squares[EP_COL_DIGIT])
 
-def set_ep_square(board, row, col):
-    board -= ((board // POWERS[EP_ROW_DIGIT]) %  NUM_PIECES)*POWERS[EP_ROW_DIGIT]
-    board -= ((board // POWERS[EP_COL_DIGIT]) %  NUM_PIECES)*POWERS[EP_COL_DIGIT]
-    board += row*POWERS[EP_ROW_DIGIT]
-    board += col*POWERS[EP_COL_DIGIT]
-    return board
+# The following helpers modify a board's squares in place, and so should only
+# be used on a fresh copy (see make_move())
+def set_ep_square(squares, row, col):
+    squares[EP_ROW_DIGIT] = row
+    squares[EP_COL_DIGIT] = col
 
-def reset_ep_square(board):
-    return set_ep_square(board, 8, 8)
+def reset_ep_square(squares):
+    set_ep_square(squares, 8, 8)
 
 def get_castling_rights(board, side):
     if side == 1:
-        castle_digit = WHITE_CASTLE_DIGIT
+        return board.squares[WHITE_CASTLE_DIGIT]
     else:
-        castle_digit = BLACK_CASTLE_DIGIT
-    return (board // POWERS[castle_digit]) % NUM_PIECES
+        return board.squares[BLACK_CASTLE_DIGIT]
 
-def remove_castling_rights(board, side, castle_side):
+def remove_castling_rights(squares, side, castle_side):
     if side == 1:
         castle_digit = WHITE_CASTLE_DIGIT
     else:
         castle_digit = BLACK_CASTLE_DIGIT
-    castle_rights = (board // POWERS[castle_digit]) % NUM_PIECES
-    new_castle_rights = castle_rights
+    castle_rights = squares[castle_digit]
     # Kingside
     if castle_side == 1:
         if castle_rights == 3:
-            new_castle_rights = 2
+            squares[castle_digit] = 2
         elif castle_rights == 1:
-            new_castle_rights = 0
+            squares[castle_digit] = 0
     # Queenside
     else:
         if castle_rights == 3:
-            new_castle_rights = 1
+            squares[castle_digit] = 1
         elif castle_rights == 2:
-            new_castle_rights = 0
-    diff = new_castle_rights - castle_rights
-    return board + diff*POWERS[castle_digit]
+            squares[castle_digit] = 0
 
-def promote(board, side, col):
+def promote(squares, side, col):
     if side == 1:
         row = 0
     else:
@@ -188,14 +249,12 @@ def promote(board, side, col):
     # For now, just put a queen there
     # 8  = 9 - 1 = queen - pawn
     # 8 = 10 - 2 = queen - pawn
-    board += 8 * POWERS[square]
-    return board
+    squares[square] += 8
 
 def piece_at_square(board, row, col):
     if not in_bounds(row, col):
         return None
-    square = row*8 + col
-    return (board // POWERS[square]) % NUM_PIECES
+    return board.squares[row*8 + col]
 
 def square_is_empty(board, row, col):
     return (not piece_at_square(board, row, col))
@@ -209,102 +268,163 @@ def get_side(piece):
         return 1
 
 def make_move(board, start, finish):
-    piece = piece_at_square(board, *start)
+    new_board = Board(bytearray(board.squares), board.key, board.score, board.halfmove)
+    play_move(new_board, start, finish)
+    return new_board
+
+def play_move(board, start, finish):
+    ''' Makes a move on board itself, updating its key, score and halfmove
+    clock, and its bitboards if they've been computed. Everything else treats
+    boards as immutable and uses make_move(), which does this on a copy; MCTS
+    playouts use it directly so as not to build a new board every move.'''
+    squares = board.squares
+    bitboards = board.bitboards
+    # Castling rights and en passant square before the move
+    old_digits = squares[WHITE_CASTLE_DIGIT:]
+    start_square = start[0]*8 + start[1]
+    finish_square = finish[0]*8 + finish[1]
+    piece = squares[start_square]
+    captured = squares[finish_square]
     # Note whether or not we're doing ep
     is_ep = ((piece == 1 or piece == 2) and finish == get_ep_square(board))
     # If there was en passant possible at a square, make it impossible
-    board = reset_ep_square(board)
+    reset_ep_square(squares)
     # If moving a pawn two squares, put in the ep
     # White pawn special rules
     if piece == 1:
         if finish[0] == start[0] - 2:
-            board = set_ep_square(board, start[0]-1, start[1])
+            set_ep_square(squares, start[0]-1, start[1])
     # Black pawn
     elif piece == 2:
         if finish[0] == start[0] + 2:
-            board = set_ep_square(board, start[0]+1, start[1])
+            set_ep_square(squares, start[0]+1, start[1])
     # If moving a rook, remove those castling rights
     # White kingside rook
     if start == (7, 7) or finish == (7, 7):
-        board = remove_castling_rights(board, 1, 1)
+        remove_castling_rights(squares, 1, 1)
     # White queenside rook
     elif start == (7, 0) or finish == (7, 0):
-        board = remove_castling_rights(board, 1, -1)
+        remove_castling_rights(squares, 1, -1)
     # Black kingside rook
     elif start == (0, 7) or finish == (0, 7):
-        board = remove_castling_rights(board, -1, 1)
+        remove_castling_rights(squares, -1, 1)
     # Black queenside rook
     elif start == (0, 0) or finish == (0, 0):
-        board = remove_castling_rights(board, -1, -1)
+        remove_castling_rights(squares, -1, -1)
     # If moving a king, remove all castling rights
     if piece == 11:
-        board = remove_castling_rights(board, 1, 1)
-        board = remove_castling_rights(board, 1, -1)
+        remove_castling_rights(squares, 1, 1)
+        remove_castling_rights(squares, 1, -1)
     elif piece == 12:
-        board = remove_castling_rights(board, -1, 1)
-        board = remove_castling_rights(board, -1, -1)
-    start_square = start[0]*8 + start[1]
-    finish_square = finish[0]*8 + finish[1]
-    if piece_at_square(board, *finish) is None:
-        breakpoint()
-    diff = piece*POWERS[finish_square] - \
-            piece*POWERS[start_square] - \
-            piece_at_square(board, *finish)*POWERS[finish_square]
+        remove_castling_rights(squares, -1, 1)
+        remove_castling_rights(squares, -1, -1)
+    # Update the key and score for everything but the finish square, which is
+    # done below (after any promotion)
+    piece_square = heuristic.PIECE_SQUARE
+    key = board.key ^ ZOBRIST[start_square][piece] ^ ZOBRIST[finish_square][captured]
+    score = board.score - piece_square[piece][start_square] - piece_square[captured][finish_square]
+    for digit in range(WHITE_CASTLE_DIGIT, NUM_DIGITS):
+        key ^= ZOBRIST[digit][old_digits[digit - WHITE_CASTLE_DIGIT]] ^ ZOBRIST[digit][squares[digit]]
+    if bitboards is not None:
+        bitboards[piece] ^= 1 << start_square
+        if captured:
+            bitboards[captured] ^= 1 << finish_square
+    squares[finish_square] = piece
+    squares[start_square] = EMPTY
     if is_ep:
         # White pawn: get rid of black pawn below it
         if piece == 1:
             removed_square = finish_square+8
-            diff -= 2*POWERS[removed_square]
         # Black pawn: get rid of white pawn above it
         else:
             removed_square = finish_square-8
-            diff -= 1*POWERS[removed_square]
+        key ^= ZOBRIST[removed_square][squares[removed_square]]
+        score -= piece_square[squares[removed_square]][removed_square]
+        if bitboards is not None and squares[removed_square]:
+            bitboards[squares[removed_square]] ^= 1 << removed_square
+        squares[removed_square] = EMPTY
     # Deal with castling by also moving the rook
-    elif piece == 11:
-        # White castling kingside
+    elif piece == 11 or piece == 12:
+        # Castling kingside
         if finish[1] == start[1]+2:
             old_rook_square = finish_square+1
             new_rook_square = finish_square-1
-            diff += 7*(POWERS[new_rook_square] - POWERS[old_rook_square])
-        # White castling queenside
+            key ^= ZOBRIST[new_rook_square][squares[new_rook_square]] \
+                    ^ ZOBRIST[new_rook_square][squares[old_rook_square]] \
+                    ^ ZOBRIST[old_rook_square][squares[old_rook_square]]
+            score += piece_square[squares[old_rook_square]][new_rook_square] \
+                    - piece_square[squares[old_rook_square]][old_rook_square] \
+                    - piece_square[squares[new_rook_square]][new_rook_square]
+            if bitboards is not None:
+                move_rook_bitboards(bitboards, squares, old_rook_square, new_rook_square)
+            squares[new_rook_square] = squares[old_rook_square]
+            squares[old_rook_square] = EMPTY
+        # Castling queenside
         elif finish[1] == start[1]-2:
             old_rook_square = finish_square-2
             new_rook_square = finish_square+1
-            diff += 7*(POWERS[new_rook_square] - POWERS[old_rook_square])
-    elif piece == 12:
-        # Black castling kingside
-        if finish[1] == start[1]+2:
-            old_rook_square = finish_square+1
-            new_rook_square = finish_square-1
-            diff += 8*(POWERS[new_rook_square] - POWERS[old_rook_square])
-        # Black castling queenside
-        elif finish[1] == start[1]-2:
-            old_rook_square = finish_square-2
-            new_rook_square = finish_square+1
-            diff += 8*(POWERS[new_rook_square] - POWERS[old_rook_square])
-
-    board = board + diff
-    # Deal with promotion/en passant
+            key ^= ZOBRIST[new_rook_square][squares[new_rook_square]] \
+                    ^ ZOBRIST[new_rook_square][squares[old_rook_square]] \
+                    ^ ZOBRIST[old_rook_square][squares[old_rook_square]]
+            score += piece_square[squares[old_rook_square]][new_rook_square] \
+                    - piece_square[squares[old_rook_square]][old_rook_square] \
+                    - piece_square[squares[new_rook_square]][new_rook_square]
+            if bitboards is not None:
+                move_rook_bitboards(bitboards, squares, old_rook_square, new_rook_square)
+            squares[new_rook_square] = squares[old_rook_square]
+            squares[old_rook_square] = EMPTY
+    # Deal with promotion
     # White pawn
     if piece == 1:
         if finish[0] == 0:
-            board = promote(board, 1, finish[1])
+            promote(squares, 1, finish[1])
     # Black pawn
     elif piece == 2:
         if finish[0] == 7:
-            board = promote(board, -1, finish[1])
-    return board
+            promote(squares, -1, finish[1])
+    key ^= ZOBRIST[finish_square][squares[finish_square]]
+    score += piece_square[squares[finish_square]][finish_square]
+    if bitboards is not None:
+        bitboards[squares[finish_square]] ^= 1 << finish_square
+    if DEBUG_INCREMENTAL:
+        assert key == compute_key(squares), 'incrementally updated Zobrist key is wrong'
+        assert abs(score - compute_score(squares)) < 1e-6, 'incrementally updated score is wrong'
+        if bitboards is not None:
+            board.bitboards = None
+            assert bitboards == get_bitboards(board), 'incrementally updated bitboards are wrong'
+    board.key = key
+    board.score = score
+    if piece == 1 or piece == 2 or captured:
+        board.halfmove = 0
+    else:
+        board.halfmove += 1
+
+def move_rook_bitboards(bitboards, squares, old_rook_square, new_rook_square):
+    ''' Updates bitboards for the rook move in castling, before it's made on squares'''
+    if squares[new_rook_square]:
+        bitboards[squares[new_rook_square]] ^= 1 << new_rook_square
+    if squares[old_rook_square]:
+        bitboards[squares[old_rook_square]] ^= (1 << old_rook_square) | (1 << new_rook_square)
+
+
+def pack_move(move):
+    ''' Packs a move ((row, col), (row, col)) into a single int below 4096'''
+    (start_row, start_col), (finish_row, finish_col) = move
+    return (start_row*8 + start_col)*64 + finish_row*8 + finish_col
+
+def unpack_move(code):
+    start, finish = divmod(code, 64)
+    return (SQUARE_COORDS[start], SQUARE_COORDS[finish])
 
 def find_king(board, side):
     if side == 1:
         king = WHITE_KING
     else:
         king = BLACK_KING
-    for row in range(8):
-        for col in range(8):
-            if king == piece_at_square(board, row, col):
-                return (row, col)
-    return None
+    square = board.squares.find(king, 0, 64)
+    if square == -1:
+        return None
+    return divmod(square, 8)
 
 def test_check(board, side):
     king_square = find_king(board, side)
@@ -536,6 +656,8 @@ def get_moves(board, row, col, check_threat=False, check_check=False):
         moves = get_moves_queen(board, row, col, check_threat)
     else:
         moves = get_moves_king(board, row, col, check_threat)
+    if check_check and not check_threat:
+        return get_legal_moves(board, row, col, moves=[move for move in moves if is_legal(board, (row, col), move)])
     return [move for move in moves if is_legal(board, (row, col), move, check_threat, check_check)]
 
 def get_moves_pawn(board, row, col, check_threat=False, test_check=False):
@@ -647,26 +769,356 @@ def get_moves_king(board, row, col, check_threat=False):
                     moves.append((row, col-2))
     return moves
 
+def get_check_info(board, side):
+    ''' Works out, from the king's square, what a move by side has to do to
+    not leave its king in check. Returns (checks, pins): checks is a list with,
+    for each piece giving check, the set of squares a move by a piece other
+    than the king could go to to stop that check (the checking piece's square,
+    plus any squares between it and the king), or None if side has no king;
+    pins maps the square of each pinned piece to the set of squares it can
+    move to without exposing the king.'''
+    king_square = find_king(board, side)
+    if king_square is None:
+        return None, {}
+    squares = board.squares
+    if side == 1:
+        enemy_pawn, enemy_knight, enemy_king = BLACK_PAWN, BLACK_KNIGHT, BLACK_KING
+        diag_sliders = (BLACK_BISHOP, BLACK_QUEEN)
+        orthog_sliders = (BLACK_ROOK, BLACK_QUEEN)
+        pawn_row = king_square[0]-1
+    else:
+        enemy_pawn, enemy_knight, enemy_king = WHITE_PAWN, WHITE_KNIGHT, WHITE_KING
+        diag_sliders = (WHITE_BISHOP, WHITE_QUEEN)
+        orthog_sliders = (WHITE_ROOK, WHITE_QUEEN)
+        pawn_row = king_square[0]+1
+    checks = []
+    pins = {}
+    row, col = king_square
+    for directions, sliders in ((DIAG_DIRECTIONS, diag_sliders), (ORTHOG_DIRECTIONS, orthog_sliders)):
+        for d_row, d_col in directions:
+            line = []
+            pinned = None
+            r, c = row+d_row, col+d_col
+            while in_bounds(r, c):
+                piece = squares[r*8 + c]
+                line.append((r, c))
+                if piece:
+                    if get_side(piece) == side:
+                        if pinned is not None:
+                            break
+                        pinned = (r, c)
+                    else:
+                        if piece in sliders:
+                            if pinned is None:
+                                checks.append(set(line))
+                            else:
+                                pins[pinned] = set(line)
+                        elif piece == enemy_king and len(line) == 1:
+                            checks.append(set(line))
+                        break
+                r += d_row
+                c += d_col
+    for d_row, d_col in KNIGHT_STEPS:
+        if piece_at_square(board, row+d_row, col+d_col) == enemy_knight:
+            checks.append({(row+d_row, col+d_col)})
+    for pawn_col in (col-1, col+1):
+        if piece_at_square(board, pawn_row, pawn_col) == enemy_pawn:
+            checks.append({(pawn_row, pawn_col)})
+    return checks, pins
+
+def get_legal_moves(board, row, col, check_info=None, moves=None):
+    ''' Legal moves for the piece at (row, col). Rather than making each move
+    and looking for check, uses the checks and pins from get_check_info()
+    (which can be passed in, if already computed for this side). Only king
+    moves and en passant, which can uncover checks in other ways, are tested
+    by making the move. moves are the piece's pseudo-legal moves, if already
+    generated.'''
+    start = (row, col)
+    piece = piece_at_square(board, row, col)
+    side = get_side(piece)
+    if moves is None:
+        moves = get_moves(board, row, col)
+    if check_info is None:
+        check_info = get_check_info(board, side)
+    checks, pins = check_info
+    # Without a king, nothing is illegal
+    if checks is None:
+        return moves
+    if piece == WHITE_KING or piece == BLACK_KING:
+        return [move for move in moves if not test_check(make_move(board, start, move), side)]
+    # Only the king can get out of double check
+    if len(checks) > 1:
+        return []
+    pin = pins.get(start)
+    ep_square = get_ep_square(board)
+    legal = []
+    for move in moves:
+        if (piece == WHITE_PAWN or piece == BLACK_PAWN) and move == ep_square:
+            if not test_check(make_move(board, start, move), side):
+                legal.append(move)
+        elif (pin is None or move in pin) and (not checks or move in checks[0]):
+            legal.append(move)
+    return legal
+
 def has_no_moves(board, side):
-    for row in range(8):
-        for col in range(8):
-            if get_side(piece_at_square(board, row, col)) == side:
-                # print(get_moves(board, row, col, check_check=True))
-                if get_moves(board, row, col, check_check=True):
-                    return False
+    squares = board.squares
+    check_info = get_check_info(board, side)
+    for square in range(64):
+        if get_side(squares[square]) == side:
+            row, col = divmod(square, 8)
+            # print(get_moves(board, row, col, check_check=True))
+            if get_legal_moves(board, row, col, check_info):
+                return False
     return True
 
 
 def get_all_moves(board, side):
     moves = []
-    for row in range(8):
-        for col in range(8):
-            if get_side(piece_at_square(board, row, col)) == side:
-                for move in get_moves(board, row, col, False, True):
-                    moves.append(((row, col), move))
+    squares = board.squares
+    check_info = get_check_info(board, side)
+    for square in range(64):
+        if get_side(squares[square]) == side:
+            row, col = divmod(square, 8)
+            for move in get_legal_moves(board, row, col, check_info):
+                moves.append(((row, col), move))
     return moves
 
 
+# Bitboard backend: the same move generation and check detection as above, but
+# with one 64-bit mask per piece (bit i is set if the piece is on square i,
+# counting horizontally from the upper left as in set_board()) and precomputed
+# attack tables. Agents can choose between the two through BACKENDS.
+
+SQUARE_COORDS = [divmod(square, 8) for square in range(64)]
+
+KNIGHT_STEPS = ((2, -1), (2, 1), (1, -2), (1, 2), (-1, -2), (-1, 2), (-2, -1), (-2, 1))
+KING_STEPS = ((0, 1), (1, 0), (1, 1), (-1, 0), (0, -1), (-1, -1), (1, -1), (-1, 1))
+DIAG_DIRECTIONS = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+ORTHOG_DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+def _step_attacks(steps):
+    attacks = []
+    for row, col in SQUARE_COORDS:
+        mask = 0
+        for d_row, d_col in steps:
+            if in_bounds(row+d_row, col+d_col):
+                mask |= 1 << ((row+d_row)*8 + col+d_col)
+        attacks.append(mask)
+    return attacks
+
+def _rays(direction):
+    rays = []
+    for row, col in SQUARE_COORDS:
+        mask = 0
+        i = 1
+        while in_bounds(row+i*direction[0], col+i*direction[1]):
+            mask |= 1 << ((row+i*direction[0])*8 + col+i*direction[1])
+            i += 1
+        rays.append(mask)
+    return rays
+
+KNIGHT_ATTACKS = _step_attacks(KNIGHT_STEPS)
+KING_ATTACKS = _step_attacks(KING_STEPS)
+# White pawns attack upwards (towards row 0), black pawns downwards
+WHITE_PAWN_ATTACKS = _step_attacks(((-1, -1), (-1, 1)))
+BLACK_PAWN_ATTACKS = _step_attacks(((1, -1), (1, 1)))
+# Each entry is (rays, whether the ray runs towards higher square indices)
+DIAG_RAYS = [(_rays(d), d[0]*8 + d[1] > 0) for d in DIAG_DIRECTIONS]
+ORTHOG_RAYS = [(_rays(d), d[0]*8 + d[1] > 0) for d in ORTHOG_DIRECTIONS]
+
+def lowest_square(mask):
+    return (mask & -mask).bit_length() - 1
+
+def get_bitboards(board):
+    ''' Returns a list of masks indexed by piece, so that bitboards[WHITE_ROOK]
+    has a bit set for every white rook. Computed once per board.'''
+    if board.bitboards is None:
+        bitboards = [0]*NUM_PIECES
+        squares = board.squares
+        for square in range(64):
+            if squares[square]:
+                bitboards[squares[square]] |= 1 << square
+        board.bitboards = bitboards
+    return board.bitboards
+
+def slider_attacks(square, occupied, rays):
+    ''' Squares attacked along the given rays, up to and including the first
+    occupied square on each'''
+    attacks = 0
+    for ray, increasing in rays:
+        mask = ray[square]
+        blockers = mask & occupied
+        if blockers:
+            if increasing:
+                blocker = lowest_square(blockers)
+            else:
+                blocker = blockers.bit_length() - 1
+            mask ^= ray[blocker]
+        attacks |= mask
+    return attacks
+
+def square_attacked(bitboards, occupied, square, side):
+    ''' Whether any piece of the given side attacks the given square'''
+    if side == 1:
+        # A white pawn attacks this square from one of the squares that a
+        # black pawn here would attack, and vice versa
+        if BLACK_PAWN_ATTACKS[square] & bitboards[WHITE_PAWN]:
+            return True
+        knights, kings = bitboards[WHITE_KNIGHT], bitboards[WHITE_KING]
+        diags = bitboards[WHITE_BISHOP] | bitboards[WHITE_QUEEN]
+        orthogs = bitboards[WHITE_ROOK] | bitboards[WHITE_QUEEN]
+    else:
+        if WHITE_PAWN_ATTACKS[square] & bitboards[BLACK_PAWN]:
+            return True
+        knights, kings = bitboards[BLACK_KNIGHT], bitboards[BLACK_KING]
+        diags = bitboards[BLACK_BISHOP] | bitboards[BLACK_QUEEN]
+        orthogs = bitboards[BLACK_ROOK] | bitboards[BLACK_QUEEN]
+    if KNIGHT_ATTACKS[square] & knights or KING_ATTACKS[square] & kings:
+        return True
+    if diags and slider_attacks(square, occupied, DIAG_RAYS) & diags:
+        return True
+    if orthogs and slider_attacks(square, occupied, ORTHOG_RAYS) & orthogs:
+        return True
+    return False
+
+def get_occupied(bitboards):
+    occupied = 0
+    for mask in bitboards:
+        occupied |= mask
+    return occupied
+
+def get_side_masks(bitboards):
+    ''' Returns the masks of all white pieces and all black pieces'''
+    white = bitboards[WHITE_PAWN] | bitboards[WHITE_KNIGHT] | bitboards[WHITE_BISHOP] \
+            | bitboards[WHITE_ROOK] | bitboards[WHITE_QUEEN] | bitboards[WHITE_KING]
+    black = bitboards[BLACK_PAWN] | bitboards[BLACK_KNIGHT] | bitboards[BLACK_BISHOP] \
+            | bitboards[BLACK_ROOK] | bitboards[BLACK_QUEEN] | bitboards[BLACK_KING]
+    return white, black
+
+def test_check_bitboard(board, side):
+    bitboards = get_bitboards(board)
+    king = bitboards[WHITE_KING if side == 1 else BLACK_KING]
+    if not king:
+        return False
+    # Like find_king(), take the first king counting from the upper left
+    return square_attacked(bitboards, get_occupied(bitboards), lowest_square(king), -side)
+
+def leaves_in_check(board, side, start, finish):
+    ''' Equivalent to test_check(make_move(board, start, finish), side), but
+    only updates the bitboards rather than building the new board'''
+    squares = board.squares
+    bitboards = list(get_bitboards(board))
+    piece = squares[start]
+    bitboards[piece] ^= (1 << start) | (1 << finish)
+    if squares[finish]:
+        bitboards[squares[finish]] ^= 1 << finish
+    if piece == WHITE_PAWN or piece == BLACK_PAWN:
+        if SQUARE_COORDS[finish] == get_ep_square(board):
+            removed_square = finish+8 if piece == WHITE_PAWN else finish-8
+            if squares[removed_square]:
+                bitboards[squares[removed_square]] ^= 1 << removed_square
+    elif piece == WHITE_KING or piece == BLACK_KING:
+        # Castling also moves the rook
+        if finish == start+2:
+            old_rook_square, new_rook_square = finish+1, finish-1
+        elif finish == start-2:
+            old_rook_square, new_rook_square = finish-2, finish+1
+        else:
+            old_rook_square = None
+        if old_rook_square is not None and squares[old_rook_square]:
+            bitboards[squares[old_rook_square]] ^= (1 << old_rook_square) | (1 << new_rook_square)
+    king = bitboards[WHITE_KING if side == 1 else BLACK_KING]
+    if not king:
+        return False
+    return square_attacked(bitboards, get_occupied(bitboards), lowest_square(king), -side)
+
+def get_all_moves_bitboard(board, side):
+    ''' Same moves as get_all_moves(), generated from the bitboards'''
+    return [(SQUARE_COORDS[start], SQUARE_COORDS[finish]) for start, finish in get_pseudo_legal_moves(board, side)
+            if not leaves_in_check(board, side, start, finish)]
+
+def get_pseudo_legal_moves(board, side):
+    ''' Returns the moves side could make if leaving its king in check were
+    allowed (though castling out of or through check isn't), as (start,
+    finish) square indices'''
+    squares = board.squares
+    bitboards = get_bitboards(board)
+    white, black = get_side_masks(bitboards)
+    if side == 1:
+        own, enemy = white, black
+        pawn_attacks = WHITE_PAWN_ATTACKS
+    else:
+        own, enemy = black, white
+        pawn_attacks = BLACK_PAWN_ATTACKS
+    occupied = white | black
+    ep_row, ep_col = get_ep_square(board)
+    ep_mask = 1 << (ep_row*8 + ep_col) if ep_row < 8 else 0
+    moves = []
+    pieces = own
+    while pieces:
+        start = lowest_square(pieces)
+        pieces &= pieces - 1
+        piece = squares[start]
+        if piece == WHITE_PAWN:
+            targets = pawn_attacks[start] & (enemy | ep_mask)
+            if start >= 8 and not occupied & (1 << (start-8)):
+                targets |= 1 << (start-8)
+                if 48 <= start < 56 and not occupied & (1 << (start-16)):
+                    targets |= 1 << (start-16)
+        elif piece == BLACK_PAWN:
+            targets = pawn_attacks[start] & (enemy | ep_mask)
+            if start < 56 and not occupied & (1 << (start+8)):
+                targets |= 1 << (start+8)
+                if 8 <= start < 16 and not occupied & (1 << (start+16)):
+                    targets |= 1 << (start+16)
+        elif piece == WHITE_KNIGHT or piece == BLACK_KNIGHT:
+            targets = KNIGHT_ATTACKS[start]
+        elif piece == WHITE_BISHOP or piece == BLACK_BISHOP:
+            targets = slider_attacks(start, occupied, DIAG_RAYS)
+        elif piece == WHITE_ROOK or piece == BLACK_ROOK:
+            targets = slider_attacks(start, occupied, ORTHOG_RAYS)
+        elif piece == WHITE_QUEEN or piece == BLACK_QUEEN:
+            targets = slider_attacks(start, occupied, DIAG_RAYS) \
+                    | slider_attacks(start, occupied, ORTHOG_RAYS)
+        else:
+            targets = KING_ATTACKS[start]
+            castle_rights = get_castling_rights(board, side)
+            col = start % 8
+            if castle_rights and not square_attacked(bitboards, occupied, start, -side):
+                if (castle_rights == 1 or castle_rights == 3) and col <= 5:
+                    if not occupied & ((1 << (start+1)) | (1 << (start+2))) \
+                            and not leaves_in_check(board, side, start, start+1):
+                        targets |= 1 << (start+2)
+                if (castle_rights == 2 or castle_rights == 3) and col >= 3:
+                    if not occupied & ((1 << (start-1)) | (1 << (start-2)) | (1 << (start-3))) \
+                            and not leaves_in_check(board, side, start, start-1):
+                        targets |= 1 << (start-2)
+        targets &= ~own
+        while targets:
+            # lowest_square(), inlined since this is the innermost loop
+            bit = targets & -targets
+            moves.append((start, bit.bit_length() - 1))
+            targets ^= bit
+    return moves
+
+def has_no_moves_bitboard(board, side):
+    ''' Same as has_no_moves(), from the bitboards: stops at the first
+    pseudo-legal move that doesn't leave side in check'''
+    for start, finish in get_pseudo_legal_moves(board, side):
+        if not leaves_in_check(board, side, start, finish):
+            return False
+    return True
+
+BACKENDS = {
+    'array': (get_all_moves, test_check),
+    'bitboard': (get_all_moves_bitboard, test_check_bitboard),
+}
+# How get_result() finds out whether there are any moves, for each backend
+NO_MOVES = {
+    'array': has_no_moves,
+    'bitboard': has_no_moves_bitboard,
+}
+
 
 def make_AI_move(board, side, AI_agent):
     #move = alpha_beta(board, 0, -100000, 100000, side)[0]
@@ -680,12 +1132,88 @@ def print_board(board):
             print(piece_at_square(board, row, col), end=' ')
         print()
 
-def get_result(board, pos_counts, variant, side, print_result=True):
-    if has_no_moves(board, -side):
-        if test_check(board, -side):
+# Draw once this many moves have been made since the last capture or pawn move
+# (fifty by each side)
+FIFTY_MOVE_PLIES = 100
+
+def insufficient_material(board):
+    ''' Whether neither side has enough material left to checkmate: nothing
+    but the kings and either a single knight, or bishops that are all on the
+    same color of square'''
+    squares = board.squares
+    for piece in (WHITE_PAWN, BLACK_PAWN, WHITE_ROOK, BLACK_ROOK, WHITE_QUEEN, BLACK_QUEEN):
+        if squares.find(piece, 0, 64) != -1:
+            return False
+    knights = squares.count(WHITE_KNIGHT, 0, 64) + squares.count(BLACK_KNIGHT, 0, 64)
+    bishop_colors = set()
+    for square in range(64):
+        if squares[square] == WHITE_BISHOP or squares[square] == BLACK_BISHOP:
+            bishop_colors.add((square//8 + square) % 2)
+    if knights == 0:
+        return len(bishop_colors) <= 1
+    return knights == 1 and not bishop_colors
+
+def has_non_pawn_material(board, side):
+    ''' Whether side has any pieces besides its pawns and king. Positions
+    where it doesn't are the ones where zugzwang is likely.'''
+    squares = board.squares
+    pieces = (WHITE_KNIGHT, WHITE_BISHOP, WHITE_ROOK, WHITE_QUEEN) if side == 1 \
+        else (BLACK_KNIGHT, BLACK_BISHOP, BLACK_ROOK, BLACK_QUEEN)
+    for piece in pieces:
+        if squares.find(piece, 0, 64) != -1:
+            return True
+    return False
+
+class GameState(object):
+    ''' The history of a game that get_result() needs: how many times each
+    position (by key) has occurred, how many positions there have been, and
+    the halfmove clock. Games and searches push() each board they move to and
+    pop() it when they move back, so all of these are kept up to date
+    incrementally. Indexing by key gives the position's count, as with the
+    plain dictionary this replaces.'''
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.positions = 0
+        self.halfmove_clocks = []
+
+    def __getitem__(self, key):
+        return self.counts.get(key, 0)
+
+    def push(self, board):
+        self.counts[board.key] += 1
+        self.positions += 1
+        self.halfmove_clocks.append(board.halfmove)
+
+    def pop(self, board):
+        self.counts[board.key] -= 1
+        self.positions -= 1
+        self.halfmove_clocks.pop()
+
+    def plies(self):
+        return self.positions - 1
+
+    def halfmove_clock(self):
+        return self.halfmove_clocks[-1] if self.halfmove_clocks else 0
+
+def get_result(board, pos_counts, variant, side, print_result=True, moves=None, backend='array', has_moves=None):
+    ''' Returns 1 if White has won, -1 if Black has, 0 for a draw, or None if
+    the game isn't over. side is the side that just moved; if -side's legal
+    moves have already been generated, passing them as moves saves generating
+    them again, and so does passing has_moves if it's already known whether
+    there are any. Otherwise they're looked for with the given backend (see
+    BACKENDS), which also tests for check.'''
+    if has_moves is not None:
+        no_moves = not has_moves
+    elif moves is not None:
+        no_moves = not moves
+    else:
+        no_moves = NO_MOVES[backend](board, -side)
+    if no_moves:
+        if BACKENDS[backend][1](board, -side):
             if print_result:
                 print('{} wins!'.format('White' if side == 1 else 'Black'))
-            return 1
+            return side
         elif side == -1 and variant == 'horde':
             if print_result:
                 print('Black wins!')
@@ -695,13 +1223,21 @@ def get_result(board, pos_counts, variant, side, print_result=True):
                 print('Stalemate.')
             return 0
         # wait for human to click?
-    elif pos_counts[board] == 3:
+    elif pos_counts[board.key] >= 3:
         if print_result:
             print('Draw by threefold repetition.')
         return 0
-    elif sum(pos_counts.values()) >= 200:
+    elif pos_counts.halfmove_clock() >= FIFTY_MOVE_PLIES:
+        if print_result:
+            print('Draw by the fifty-move rule.')
+        return 0
+    # In horde, White has no king to be checkmated
+    elif variant != 'horde' and insufficient_material(board):
+        if print_result:
+            print('Draw by insufficient material.')
+        return 0
+    elif pos_counts.positions >= 200:
         if print_result:
             print('Draw by being a really long game.')
         return 0
     return None
-
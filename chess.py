@@ -6,7 +6,6 @@ This file mostly handles IO for both display and playing the game
 '''
 
 import argparse
-from collections import defaultdict
 import pygame
 import time
 
@@ -100,7 +99,7 @@ class Human(agent.Agent):
                     piece = board.piece_at_square(chessboard, row, col)
                     if first_click:
                         if piece != None and board.get_side(piece) == self.side:
-                            moves = board.get_moves(chessboard, row, col, False, True)
+                            moves = board.get_legal_moves(chessboard, row, col)
                             #highlight available moves
                             for move in moves:
                                 highlight_square(surface, *move)
@@ -133,12 +132,12 @@ def play_game(agent1, agent2, surface, variant, wait_between):
     global last_move
     chessboard = board.set_board(variant=variant)
     result = None
-    pos_counts = defaultdict(int)
+    pos_counts = board.GameState()
     if surface:
         surface.fill([0, 0, 0])
         draw_board(chessboard, surface)
         pygame.display.flip()
-    pos_counts[chessboard] += 1
+    pos_counts.push(chessboard)
     while True:
         move = agent1.get_move(chessboard, pos_counts)
         last_move = move
@@ -152,7 +151,7 @@ def play_game(agent1, agent2, surface, variant, wait_between):
             draw_board(chessboard, surface)
             pygame.display.flip()
         # checkmate checks, etc
-        pos_counts[chessboard] += 1
+        pos_counts.push(chessboard)
         result = board.get_result(chessboard, pos_counts, variant, 1)
         if result is not None:
             if wait_between:
@@ -171,7 +170,7 @@ def play_game(agent1, agent2, surface, variant, wait_between):
             surface.fill([0, 0, 0])
             draw_board(chessboard, surface)
             pygame.display.flip()
-        pos_counts[chessboard] += 1
+        pos_counts.push(chessboard)
         result = board.get_result(chessboard, pos_counts, variant, -1)
         if result is not None:
             if wait_between:
@@ -187,22 +186,61 @@ def parse_args():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--alternate-sides', action="store_true", default=False,
                         help='alternate sides (color) every other game')
+    parser.add_argument('--backend', type=str, nargs='+', default=['array'],
+                        choices=list(board.BACKENDS),
+                        help='board representation used by AI move generation')
     parser.add_argument('--display', action="store_true", default=False,
                         help='whether AI games display with the board')
     parser.add_argument('--heuristic-rollouts', type=bool, nargs='+', default=[False],
                         help='whether or not to use heuristic to guide rollouts')
     parser.add_argument('--input-file', type=str, nargs='+', default=[],
-                        help='which (pickle) file to read in the AI from')
+                        help='which file in saves/ to read in the MCTS tree from')
+    parser.add_argument('--mcts-adjudicate', type=float, nargs='+', default=[0],
+                        help='score an MCTS rollout as won once the evaluation has stayed beyond plus or minus this for --mcts-adjudicate-plies plies (0 to disable)')
+    parser.add_argument('--mcts-adjudicate-plies', type=int, nargs='+', default=[10],
+                        help='how many plies in a row the evaluation has to stay beyond --mcts-adjudicate')
     parser.add_argument('--mcts-depth', type=int, nargs='+', default=[20],
                         help='MCTS max AI search depth (0 for unlimited)')
+    parser.add_argument('--mcts-early-stop', action='store_true', default=False,
+                        help='with --mcts-time, have MCTS stop searching once the most visited move can no longer be overtaken, and play it')
+    parser.add_argument('--mcts-max-nodes', type=int, nargs='+', default=[0],
+                        help='MCTS node budget; once the tree is bigger, its least visited subtrees are evicted (0 for unlimited)')
+    parser.add_argument('--mcts-parallel', type=str, nargs='+', default=['root'],
+                        choices=['root', 'leaf'],
+                        help='how MCTS uses more than one worker: a tree per worker (root) or one shared tree whose rollouts the workers run (leaf)')
+    parser.add_argument('--mcts-prune-above', action='store_true', default=False,
+                        help='have MCTS throw away the part of its tree above the current position as the game goes on')
     parser.add_argument('--mcts-rollouts', type=int, nargs='+', default=[50],
                         help='number of MCTS rollouts')
+    parser.add_argument('--mcts-time', type=float, nargs='+', default=[0],
+                        help='MCTS time budget per move in seconds; if set, runs rollouts until it runs out instead of --mcts-rollouts of them')
+    parser.add_argument('--mcts-workers', type=int, nargs='+', default=[1],
+                        help='number of processes MCTS splits its rollouts between, each growing its own tree (--mcts-parallel root) or running rollouts from leaves of one shared tree (--mcts-parallel leaf)')
     parser.add_argument('--minimax-depth', type=int, nargs='+', default=[2],
                         help='minimax max AI search depth')
+    parser.add_argument('--minimax-hash', type=float, nargs='+', default=[16],
+                        help='minimax transposition table size in MB (0 to disable)')
+    parser.add_argument('--minimax-nodes', type=int, nargs='+', default=[0],
+                        help='minimax node budget per move; if set, searches iteratively deeper instead of to --minimax-depth')
+    parser.add_argument('--minimax-lmr', action='store_true', default=False,
+                        help='have minimax search late quiet moves a ply shallower unless they turn out to be good')
+    parser.add_argument('--minimax-no-noise', action='store_true', default=False,
+                        help='turn off the random noise minimax adds to move values, so that its searches are repeatable')
+    parser.add_argument('--minimax-null-move', action='store_true', default=False,
+                        help='have minimax prune positions where passing would still be good enough (null-move pruning)')
+    parser.add_argument('--minimax-parallel', type=str, nargs='+', default=['smp'],
+                        choices=['smp', 'split'],
+                        help='how minimax uses more than one thread: helpers sharing a transposition table (smp) or the root moves split between processes (split)')
+    parser.add_argument('--minimax-threads', type=int, nargs='+', default=[1],
+                        help='number of processes minimax searches with, sharing one transposition table (Lazy SMP)')
+    parser.add_argument('--minimax-time', type=float, nargs='+', default=[0],
+                        help='minimax time budget per move in seconds; if set, searches iteratively deeper instead of to --minimax-depth')
+    parser.add_argument('--mobility', action='store_true', default=False,
+                        help='include the (slow) mobility term in AI evaluations')
     parser.add_argument('--num-games', type=int, default=1,
                         help='how many games to play')
     parser.add_argument('--output-file', type=str, nargs='+', default=[],
-                        help='which (pickle) file to write the AI to')
+                        help='which file in saves/ to write the MCTS tree to')
     parser.add_argument('--player1', type=str, default='human',
                         help='who player 1 is (white)')
     parser.add_argument('--player2', type=str, default='minimax',
@@ -219,6 +257,16 @@ def parse_args():
     args = parser.parse_args()
     if len(args.minimax_depth) == 1:
         args.minimax_depth = args.minimax_depth * 2
+    if len(args.minimax_hash) == 1:
+        args.minimax_hash = args.minimax_hash * 2
+    if len(args.minimax_nodes) == 1:
+        args.minimax_nodes = args.minimax_nodes * 2
+    if len(args.minimax_parallel) == 1:
+        args.minimax_parallel = args.minimax_parallel * 2
+    if len(args.minimax_threads) == 1:
+        args.minimax_threads = args.minimax_threads * 2
+    if len(args.minimax_time) == 1:
+        args.minimax_time = args.minimax_time * 2
     if args.player1 == 'human' or args.player2 =='human':
         args.wait_between = True
     if len(args.input_file) == 1:
@@ -229,8 +277,22 @@ def parse_args():
         args.mcts_rollouts = args.mcts_rollouts * 2
     if len(args.mcts_depth) == 1:
         args.mcts_depth = args.mcts_depth * 2
+    if len(args.mcts_time) == 1:
+        args.mcts_time = args.mcts_time * 2
+    if len(args.mcts_workers) == 1:
+        args.mcts_workers = args.mcts_workers * 2
+    if len(args.mcts_parallel) == 1:
+        args.mcts_parallel = args.mcts_parallel * 2
+    if len(args.mcts_adjudicate) == 1:
+        args.mcts_adjudicate = args.mcts_adjudicate * 2
+    if len(args.mcts_adjudicate_plies) == 1:
+        args.mcts_adjudicate_plies = args.mcts_adjudicate_plies * 2
+    if len(args.mcts_max_nodes) == 1:
+        args.mcts_max_nodes = args.mcts_max_nodes * 2
     if len(args.ucb_const) == 1:
         args.ucb_const = args.ucb_const * 2
+    if len(args.backend) == 1:
+        args.backend = args.backend * 2
 
     return args
 
@@ -238,27 +300,37 @@ def main(args):
     if args.player1 == "human":
         agent1 = Human(1,surface)
     elif args.player1 == "minimax":
-        agent1 = Minimax(1, args.minimax_depth[0], args.variant)
+        agent1 = Minimax(1, args.minimax_depth[0], args.variant, args.backend[0], args.minimax_hash[0],\
+         args.minimax_time[0], args.minimax_nodes[0], args.mobility, args.minimax_threads[0],\
+         args.minimax_parallel[0], not args.minimax_no_noise, args.minimax_null_move, args.minimax_lmr)
     elif args.player1 == "mcts":
         agent1 = MCTS(1, args.mcts_depth[0], args.mcts_rollouts[0],\
          args.variant, args.heuristic_rollouts[0], \
-         args.input_file[0] if args.input_file else None, args.output_file[0] if args.output_file else None, args.ucb_const[0])
+         args.input_file[0] if args.input_file else None, args.output_file[0] if args.output_file else None, args.ucb_const[0], args.backend[0], args.mobility, args.mcts_workers[0], args.mcts_parallel[0],\
+         args.mcts_adjudicate[0], args.mcts_adjudicate_plies[0], args.mcts_max_nodes[0], args.mcts_prune_above, args.mcts_time[0], args.mcts_early_stop)
 
     if args.player2 == "human":
         agent2 = Human(-1, surface)
     elif args.player2 == "minimax":
-        agent2 = Minimax(-1, args.minimax_depth[1], args.variant)
+        agent2 = Minimax(-1, args.minimax_depth[1], args.variant, args.backend[1], args.minimax_hash[1],\
+         args.minimax_time[1], args.minimax_nodes[1], args.mobility, args.minimax_threads[1],\
+         args.minimax_parallel[1], not args.minimax_no_noise, args.minimax_null_move, args.minimax_lmr)
     elif args.player2 == "mcts":
         agent2 = MCTS(1, args.mcts_depth[1], args.mcts_rollouts[1],\
          args.variant, args.heuristic_rollouts[1], args.input_file[1] if len(args.input_file) == 2 else None,\
-          args.output_file[1] if len(args.output_file) == 2 else None, args.ucb_const[1])
+          args.output_file[1] if len(args.output_file) == 2 else None, args.ucb_const[1], args.backend[1], args.mobility, args.mcts_workers[1], args.mcts_parallel[1],\
+         args.mcts_adjudicate[1], args.mcts_adjudicate_plies[1], args.mcts_max_nodes[1], args.mcts_prune_above, args.mcts_time[1], args.mcts_early_stop)
 
     for i in range(args.num_games):
         play_game(agent1, agent2, surface, args.variant, args.wait_between)
         if type(agent1) == MCTS:
-            agent1.reset(1)
+            agent1.print_tree_size(1)
         if type(agent2) == MCTS:
-            agent2.reset(-1)
+            agent2.print_tree_size(2)
+        if type(agent1) == MCTS:
+            agent1.reset()
+        if type(agent2) == MCTS:
+            agent2.reset()
         if args.alternate_sides:
             agent1.switch_sides()
             agent2.switch_sides()
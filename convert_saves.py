@@ -0,0 +1,38 @@
+'''
+Converts MCTS trees pickled by older versions (saves/*.pkl) to the flat
+binary format that MCTS now saves and memory-maps (see mcts.Tree.save()).
+Each foo.pkl is written alongside as foo.tree, and the pickle is left as it is.
+'''
+
+import argparse
+import glob
+import os
+import pickle
+import sys
+import time
+
+from mcts import Node, Tree
+
+def convert(path):
+    then = time.time()
+    # Trees of Node objects are nested as deeply as the tree is
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 100000))
+    with open(path, 'rb') as file:
+        tree = pickle.load(file)
+    if isinstance(tree, Node):
+        tree = Tree.from_nodes(tree)
+    new_path = os.path.splitext(path)[0] + '.tree'
+    tree.save(new_path)
+    print('{} -> {}: {} nodes, {:.1f} MB -> {:.1f} MB, {:.1f} seconds'.format(path, new_path, tree.size,
+        os.path.getsize(path)/2**20, os.path.getsize(new_path)/2**20, time.time()-then))
+
+def parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('files', type=str, nargs='*',
+                        help='pickle files to convert (default: all of saves/*.pkl)')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    for path in args.files or sorted(glob.glob(os.path.join('saves', '*.pkl'))):
+        convert(path)
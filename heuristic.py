@@ -42,61 +42,147 @@ MATERIAL = np.array([
     -1000
 ])
 
-def evaluate(chessboard, disp=False, intricate=False):
-    '''Returns a value indicating how favorable the board is for each player. Smaller (more negative) scores favor Black, whereas larger scores favor White.'''
-    # C = 0.1
-    total = 0
+# Piece values regardless of side, for ordering captures
+PIECE_VALUES = [abs(int(value)) for value in MATERIAL]
+
+def mvv_lva(chessboard, move):
+    '''Returns a score for ordering move if it's a capture, or None otherwise. Captures of more valuable pieces (most valuable victim) score higher, and among those, captures by less valuable pieces (least valuable attacker).'''
+    squares = chessboard.squares
+    start, finish = move
+    attacker = squares[start[0]*8 + start[1]]
+    victim = squares[finish[0]*8 + finish[1]]
+    if not victim:
+        if (attacker == board.WHITE_PAWN or attacker == board.BLACK_PAWN) \
+                and finish == board.get_ep_square(chessboard):
+            victim = attacker
+        else:
+            return None
+    return PIECE_VALUES[victim]*2000 - PIECE_VALUES[attacker]
+
+def order_captures(chessboard, moves):
+    '''Splits moves into captures, sorted by mvv_lva(), and the remaining (quiet) moves'''
+    captures = []
+    quiets = []
+    for move in moves:
+        score = mvv_lva(chessboard, move)
+        if score is None:
+            quiets.append(move)
+        else:
+            captures.append((score, move))
+    captures.sort(reverse=True, key=lambda x: x[0])
+    return [tup[1] for tup in captures], quiets
+
+def king_safety(piece, row, col):
+    '''Kings are safest on their back rank, and safest of all castled'''
+    if piece == 11:
+        if row == 7:
+            if col == 1 or col == 6:
+                return 1
+            return 0
+        else:
+            return -1
+    else:
+        if row == 0:
+            if col == 1 or col == 6:
+                return -1
+            return 0
+        else:
+            return 1
+
+# Weight of the piece-square term, relative to material
+PIECE_SQUARE_SCALAR = 1
+
+# Positional tables indexed by [piece, row, col]: king safety for the kings,
+# and for other pieces how good the square is for that side
+KING_SAFETY = np.zeros((len(MATERIAL), 8, 8))
+PIECE_SQUARE_VALS = np.zeros((len(MATERIAL), 8, 8))
+for row in range(8):
+    for col in range(8):
+        KING_SAFETY[11, row, col] = king_safety(11, row, col)
+        KING_SAFETY[12, row, col] = king_safety(12, row, col)
+for piece in range(1, 11):
+    # MOBILITY_SCALAR is already negative for Black's pieces
+    if piece % 2 == 1:
+        PIECE_SQUARE_VALS[piece] = PIECE_SQUARE_SCALAR*MOBILITY_SCALAR[piece]*WHITE_SQUARE_VALS
+    else:
+        PIECE_SQUARE_VALS[piece] = PIECE_SQUARE_SCALAR*MOBILITY_SCALAR[piece]*BLACK_SQUARE_VALS
+
+# PIECE_SQUARE[piece][square]: material plus positional value of a piece on a
+# square. board.make_move() keeps each board's total of these up to date in
+# chessboard.score, so it never needs to be recomputed. Plain lists, since
+# they're indexed one square at a time.
+PIECE_SQUARE = (MATERIAL[:, None, None] + KING_SAFETY + PIECE_SQUARE_VALS).reshape(len(MATERIAL), 64).tolist()
+
+# Mobility scores are expensive, so they're cached by board key
+MOBILITY_CACHE_SIZE = 2**16
+mobility_cache = {}
+
+def evaluate(chessboard, disp=False, intricate=False, mobility=False):
+    '''Returns a value indicating how favorable the board is for each player. Smaller (more negative) scores favor Black, whereas larger scores favor White. Without mobility this is just the board's incrementally updated material and piece-square score, so it costs O(1).'''
     if intricate:
         king_locs = (board.find_king(chessboard, 1), board.find_king(chessboard, -1))
         if not king_locs[0]:
             return -10000
         elif not king_locs[1]:
             return 10000
+    total = chessboard.score
+    if mobility or intricate:
+        total += evaluate_mobility(chessboard, disp, intricate)
+    return total
+
+def evaluate_mobility(chessboard, disp=False, intricate=False):
+    '''Values every square each piece (other than the kings) threatens.'''
+    if not disp and not intricate and chessboard.key in mobility_cache:
+        return mobility_cache[chessboard.key]
+    # C = 0.1
+    total = 0
+    if intricate:
+        king_locs = (board.find_king(chessboard, 1), board.find_king(chessboard, -1))
     for row in range(8):
         for col in range(8):
             piece = board.piece_at_square(chessboard, row, col)
-            if piece != 0:
+            if piece != 0 and piece != 11 and piece != 12:
                 piece_total = 0
-                # King safety
-                if piece == 11:
-                    # king safety
-                    if row == 7:
-                        if col == 1 or col == 6:
-                            piece_total += 1
+                side = board.get_side(piece)
+                moves = board.get_moves(chessboard, row, col, check_threat=True, check_check=True)
+                if intricate:
+                    # Value squares close to the enemy king
+                    if side == 1:
+                        enemy_king_row, enemy_king_col = king_locs[1]
                     else:
-                        piece_total -= 1
-                elif piece == 12:
-                    # king safety
-                    if row == 0:
-                        if col == 1 or col == 6:
-                            piece_total -= 1
-                    else: 
-                        piece_total += 1
+                        enemy_king_row, enemy_king_col = king_locs[0]
+                    for move in moves:
+                        king_proximity = (move[0] - enemy_king_row)**2 + (move[1] - enemy_king_col)**2
+                        # 7*7 + 7*7 = 98
+                        king_proximity /= 98
+                        piece_total += SQUARE_VALS[move]*king_proximity
                 else:
-                    side = board.get_side(piece)
-                    moves = board.get_moves(chessboard, row, col, check_threat=True, check_check=True)
-                    if intricate:
-                        # Value squares close to the enemy king
+                    for move in moves:
                         if side == 1:
-                            enemy_king_row, enemy_king_col = king_locs[1]
-                        else:
-                            enemy_king_row, enemy_king_col = king_locs[0]
-                        for move in moves:
-                            king_proximity = (move[0] - enemy_king_row)**2 + (move[1] - enemy_king_col)**2
-                            # 7*7 + 7*7 = 98
-                            king_proximity /= 98
-                            piece_total += SQUARE_VALS[move]*king_proximity
-                    else:
-                        for move in moves:
-                            if side == 1:
-                                piece_total += WHITE_SQUARE_VALS[move]
-                            elif side == -1:
-                                piece_total += BLACK_SQUARE_VALS[move]
-                    # square root to encourage developing all pieces
-                    # piece_total = piece_total**(1/3)
-                    piece_total *= MOBILITY_SCALAR[piece]
-                    if disp:
-                        print(piece, 'has mobility', piece_total)
-                piece_total += MATERIAL[piece]
+                            piece_total += WHITE_SQUARE_VALS[move]
+                        elif side == -1:
+                            piece_total += BLACK_SQUARE_VALS[move]
+                # square root to encourage developing all pieces
+                # piece_total = piece_total**(1/3)
+                piece_total *= MOBILITY_SCALAR[piece]
+                if disp:
+                    print(piece, 'has mobility', piece_total)
                 total += piece_total# + C*len(moves)
+    if not intricate:
+        if len(mobility_cache) >= MOBILITY_CACHE_SIZE:
+            mobility_cache.clear()
+        mobility_cache[chessboard.key] = total
     return total
+
+def evaluate_batch(chessboards):
+    '''Returns an array of the (mobility-free) evaluate() scores of many boards at once, computed with vectorized numpy operations on an (N, 8, 8) array of their pieces.'''
+    if not chessboards:
+        return np.zeros(0)
+    pieces = np.frombuffer(b''.join([bytes(chessboard.squares[:64]) for chessboard in chessboards]),
+                           dtype=np.int8).reshape(-1, 8, 8)
+    rows = np.arange(8)[:, None]
+    cols = np.arange(8)[None, :]
+    material = MATERIAL[pieces].sum(axis=(1, 2))
+    piece_square = PIECE_SQUARE_VALS[pieces, rows, cols].sum(axis=(1, 2))
+    king_safety = KING_SAFETY[pieces, rows, cols].sum(axis=(1, 2))
+    return material + piece_square + king_safety
@@ -1,195 +1,686 @@
+import concurrent.futures
+import copy
 import math
+import mmap
+import multiprocessing
 import os
 import pickle
 import random
+import struct
+import sys
 from time import time
-from collections import defaultdict
+
+import numpy as np
 
 import agent
 import board
 import heuristic
+
+# How much a rollout still in progress counts against its path in selection:
+# the same as a lost game
+VIRTUAL_LOSS = 100000
+# Once a tree goes over its node budget, it's cut down to this fraction of it,
+# so that it isn't cut again on the very next move
+EVICTION_TARGET = 0.75
+# With a time limit and early stopping, how many rollouts are run between
+# checks of whether the most visited move can still be overtaken
+EARLY_STOP_INTERVAL = 16
+
 class MCTS(agent.Agent):
-    def __init__(self, side, max_depth, n_rollouts, variant, use_heuristic, input_path, output_path, ucb_const):
+    def __init__(self, side, max_depth, n_rollouts, variant, use_heuristic, input_path, output_path, ucb_const, backend='array', mobility=False, workers=1, parallel='root', adjudicate_eval=0, adjudicate_plies=10, max_nodes=0, prune_above=False, time_limit=0, early_stop=False):
         self.side = side
         self.max_depth = max_depth
         self.n_rollouts = n_rollouts
         self.variant = variant
         self.use_heuristic = use_heuristic
+        # Whether rollout cutoffs are evaluated with the (expensive) mobility term
+        self.mobility = mobility
+        # If set, a rollout counts as won once the evaluation has been beyond
+        # +/-adjudicate_eval for adjudicate_plies plies in a row
+        self.adjudicate_eval = adjudicate_eval
+        self.adjudicate_plies = adjudicate_plies
+        # If set, low-visit subtrees are evicted whenever the tree has more
+        # than max_nodes nodes
+        self.max_nodes = max_nodes
+        # If set, everything above self.cur is thrown away as the game goes on
+        self.prune_above = prune_above
+        # If set, each search runs rollouts for time_limit seconds instead of
+        # running n_rollouts of them, and with early_stop it ends as soon as
+        # the most visited move can't be caught in the time left (the most
+        # visited move is then the one played)
+        self.time_limit = time_limit
+        self.early_stop = early_stop
         self.ucb_const = ucb_const
         self.input_path = input_path
         self.output_path = output_path
-        self.random_moves_list = []
+        self.backend = backend
+        self.get_all_moves, self.test_check = board.BACKENDS[backend]
+        # With more than one worker, either each worker process grows its own
+        # tree from the current position and their statistics for the moves
+        # there are merged ('root'), or one tree is searched and the workers
+        # run the rollouts from its leaves ('leaf')
+        self.workers = workers
+        self.parallel = parallel
+        self.pool = None
+        self.executor = None
         if input_path:
             self.load_root()
         else:
-            self.root = Node(board.set_board(variant), None, self.ucb_const)
+            self.tree = Tree(board.set_board(variant))
             
-        self.cur = self.root
+        self.cur = Tree.ROOT
+        self.cur_board = self.tree.root_board
+        self.start_board = self.tree.root_board
+
+    def __getstate__(self):
+        # Worker processes are sent a copy of the agent without its tree or
+        # its worker processes
+        state = self.__dict__.copy()
+        del state['tree']
+        del state['pool']
+        del state['executor']
+        return state
 
     def load_root(self):
-        file = open(os.path.join('saves', self.input_path), 'rb')
-        self.root = pickle.load(file)
+        path = os.path.join('saves', self.input_path)
+        with open(path, 'rb') as file:
+            is_tree_file = file.read(len(TREE_FILE_MAGIC)) == TREE_FILE_MAGIC
+        if is_tree_file:
+            self.tree = Tree.load(path)
+            return
+        # Older saves are pickles, either of a Tree or (from before Tree
+        # existed) of a graph of Node objects; convert_saves.py converts them
+        file = open(path, 'rb')
+        self.tree = pickle.load(file)
+        if isinstance(self.tree, Node):
+            self.tree = Tree.from_nodes(self.tree)
     
     def store_root(self):
         if self.output_path:
-            file = open(os.path.join('saves', self.output_path), 'wb')
-            pickle.dump(self.root, file)
+            self.tree.save(os.path.join('saves', self.output_path))
 
-    def reset(self, side):
-        self.cur = self.root
-        self.side = side
+    def reset(self):
+        '''Goes back to the start of the game for the next one. self.side is the side to move at self.cur, not the colour MCTS plays, so it's White whichever that is.'''
+        if self.prune_above:
+            # What's left of the tree starts from the end of the last game
+            self.tree = Tree(self.start_board)
+        else:
+            self.tree.refresh_values(self.cur)
+        self.cur = Tree.ROOT
+        self.cur_board = self.tree.root_board
+        self.side = 1
+
+    def switch_sides(self):
+        # The side to move at self.cur doesn't change with the colour played
+        pass
 
     def get_move(self, chessboard, pos_counts):
         # then = time()
-        result = self.do_rollouts(pos_counts)
+        deadline = time() + self.time_limit if self.time_limit else None
+        if self.workers > 1 and self.parallel == 'leaf':
+            self.do_leaf_parallel_rollouts(pos_counts, deadline)
+        elif self.workers > 1:
+            self.do_parallel_rollouts(pos_counts, deadline)
+        else:
+            self.do_rollouts(pos_counts, self.n_rollouts, deadline)
+        result = self.best_move()
         # now = time()-then
         # print("get_move took " + str(now) + " seconds")
         return result
 
     def record_move(self, move):
-        if move not in self.cur.children.keys():
-            self.cur.add_move(move)
-        self.cur = self.cur.children[move]
+        self.cur = self.get_child(self.cur, move)
+        self.cur_board = board.make_move(self.cur_board, *move)
         self.side *= -1
+        if self.prune_above:
+            self.tree.reroot(self.cur, self.cur_board)
+            self.cur = Tree.ROOT
+        if self.max_nodes and self.tree.size > self.max_nodes:
+            self.evict()
 
+    def evict(self):
+        '''Cuts the tree down to EVICTION_TARGET of the node budget by removing the subtrees of the nodes with the fewest visits: first those branching off the line from the root to self.cur, then, if that isn't enough, those below self.cur. Nodes on the line itself are always kept.'''
+        tree = self.tree
+        target = int(EVICTION_TARGET*self.max_nodes)
+        on_line = np.zeros(tree.size, dtype=bool)
+        node = self.cur
+        while node != Tree.NONE:
+            on_line[node] = True
+            node = tree.parents[node]
+        below_cur = tree.subtree_mask(np.arange(tree.size) == self.cur) & ~on_line
+        removed = np.zeros(tree.size, dtype=bool)
+        for candidates in (~below_cur & ~on_line, below_cur):
+            # Find the fewest visits such that removing every candidate with
+            # at most that many is enough
+            thresholds = np.unique(tree.visits[:tree.size][candidates])
+            low, high = 0, len(thresholds) - 1
+            while low < high:
+                middle = (low + high)//2
+                mask = tree.subtree_mask(candidates & (tree.visits[:tree.size] <= thresholds[middle]))
+                if tree.size - np.count_nonzero(removed | mask) <= target:
+                    high = middle
+                else:
+                    low = middle + 1
+            if len(thresholds):
+                removed |= tree.subtree_mask(candidates & (tree.visits[:tree.size] <= thresholds[low]))
+            if tree.size - np.count_nonzero(removed) <= target:
+                break
+        # Nodes that lost children need their untried moves regenerated
+        for parent in np.unique(tree.parents[:tree.size][removed]):
+            tree.untried.pop(parent, None)
+        self.cur = tree.keep(~removed)[self.cur]
+
+    def print_tree_size(self, player):
+        '''player: which of chess.py's players (1 or 2) this agent is, since self.side only says whose turn it is at self.cur'''
+        print('MCTS (player {}): {} nodes, {:.1f} MB'.format(player, self.tree.size, self.tree.memory()/2**20))
 
-    def do_rollouts(self, pos_counts):
-        for i in range(self.n_rollouts):
-            side = self.side
-            cur = self.cur
-            cur.visits += 1
-            pos_counts[cur.chessboard] += 1
-            while len(cur.children) == len(board.get_all_moves(cur.chessboard, self.side))\
-             and board.get_result(cur.chessboard, pos_counts, self.variant, self.side, False) is None\
-             and board.get_result(cur.chessboard, pos_counts, self.variant, -self.side, False) is None:
-                if len(cur.children) == 0:
-                    breakpoint()
-                best_child = list(cur.children.values())[0]
-                for child in list(cur.children.values())[1:]:
-                    if side*(child.UCB_weight(-side)-best_child.UCB_weight(-side)) > 0:
-                        best_child = child
-                cur = best_child
-                side *= -1
-                cur.visits += 1
-                pos_counts[cur.chessboard] += 1
-            if board.get_result(cur.chessboard, pos_counts, self.variant, side, False) is not None \
-            and board.get_result(cur.chessboard, pos_counts, self.variant, -side, False) is not None:
-                continue
-            moves = board.get_all_moves(cur.chessboard, side)
-            random.shuffle(moves)
-            for move in moves:
-                if cur.add_move(move):
-                    break
-            if type(cur.children) == tuple:
-                breakpoint()
-            expanded = cur.children[move]
-            expanded.visits += 1
-            outcome = self.random_to_end(expanded.chessboard, pos_counts, -side, 0)
-            expanded.update_value(outcome, self.cur, pos_counts)
-            pos_counts[cur.chessboard] -= 1
-        
-        best_move = list(self.cur.children.keys())[0]
-        for move in self.cur.children:
-            child = self.cur.children[move]
-            best_child = self.cur.children[best_move]
-            if self.side*(child.get_value()-best_child.get_value()) > 0:
-                best_move = move
-            
-        return best_move
 
-    def random_to_end(self, chessboard, pos_counts, side, depth):
-        ''' side: which player's move it is in position chessboard''' 
-        self.random_moves_list = [] if depth == 0 else self.random_moves_list
-        result = board.get_result(chessboard, pos_counts, self.variant, -side, False)
+    def get_child(self, node, move):
+        '''Returns the child reached from node by move, adding it if it isn't in the tree yet'''
+        child = self.tree.child(node, move)
+        if child == Tree.NONE:
+            untried = self.tree.untried.get(node)
+            if untried is not None:
+                untried.remove(move)
+            child = self.tree.add_child(node, move)
+        return child
+
+    def select_leaf(self, pos_counts):
+        '''Walks down the tree from self.cur by UCB weight, and expands a new node at the first node that isn't fully expanded. Returns the new node (or the node where the game ended, if it did), the board and side to move there, the game's outcome if it's over (otherwise None), and the boards pushed onto pos_counts on the way, which the caller pops once the rollout is done.'''
+        tree = self.tree
+        side = self.side
+        node = self.cur
+        chessboard = self.cur_board
+        # Boards aren't stored in the tree, so they're rebuilt by making
+        # each move on the path down from self.cur
+        path_boards = [chessboard]
+        pos_counts.push(chessboard)
+        untried = self.untried_moves(node, chessboard, side)
+        # get_result() only needs to know whether there are any moves
+        has_moves = bool(untried) or tree.first_child[node] != Tree.NONE
+        result = board.get_result(chessboard, pos_counts, self.variant, -side, False, backend=self.backend, has_moves=has_moves)
+        while result is None and not untried:
+            node = tree.select_child(node, side, self.ucb_const)
+            chessboard = board.make_move(chessboard, *tree.move(node))
+            path_boards.append(chessboard)
+            side *= -1
+            pos_counts.push(chessboard)
+            untried = self.untried_moves(node, chessboard, side)
+            has_moves = bool(untried) or tree.first_child[node] != Tree.NONE
+            result = board.get_result(chessboard, pos_counts, self.variant, -side, False, backend=self.backend, has_moves=has_moves)
         if result is not None:
-            # Return a large number since we might be stopping early and doing
-            # a heuristic evaluation, which might be bigger than 1 or -1
-            return result*100000
-        elif self.max_depth != 0 and depth == self.max_depth:
-            return heuristic.evaluate(chessboard)
-        elif self.use_heuristic:
-            move = self.order_moves_naive(chessboard, side)[0] 
-        else:
-            moves = board.get_all_moves(chessboard, side)
-            random.shuffle(moves)
-            move = moves[0]
-        # if board.piece_at_square(chessboard, *move[0]) == 11:
-            # board.print_board(chessboard)
-            # print(board.get_castling_rights(chessboard, 1))
-            # print()
-        new_board = board.make_move(chessboard, *move)
-        self.random_moves_list.append(move)
-        piece_counts = defaultdict(int)
-        for row in range(8):
-            for col in range(8):
-                piece_counts[board.piece_at_square(new_board, row, col)] += 1
-        if piece_counts[11] != 1 or piece_counts[12] != 1:
-            breakpoint()
-        pos_counts[new_board] += 1
-        outcome = self.random_to_end(new_board, pos_counts, -side, depth+1)
-        pos_counts[new_board] -= 1
-        return outcome
-
-    def order_moves_naive(self, chessboard, side):
-        '''Given a board and a side, naively orders the set of all possible moves based solely on whether or not they involve the capture of a piece, and if so, how much the piece is worth.'''
-        moves = board.get_all_moves(chessboard, side)
-        moves_and_values = [(move, heuristic.evaluate(board.make_move(chessboard, move[0], move[1]))) for move in moves]
-        moves_and_values.sort(reverse=(side==1), key=lambda x: x[1])
-        return [tup[0] for tup in moves_and_values]
+            # The game is over at node, so there's nothing to expand
+            return node, chessboard, side, result*100000, path_boards
+        move = untried.pop()
+        expanded = tree.add_child(node, move)
+        chessboard = board.make_move(chessboard, *move)
+        path_boards.append(chessboard)
+        pos_counts.push(chessboard)
+        return expanded, chessboard, -side, None, path_boards
+
+    def do_rollouts(self, pos_counts, n_rollouts, deadline=None):
+        '''Runs n_rollouts rollouts from self.cur, or if there's a deadline, as many as there's time for but at least one, so that there's a move to pick (fewer if self.early_stop and the search is decided first)'''
+        then = time()
+        n_done = 0
+        while n_done < n_rollouts if deadline is None else n_done == 0 or time() < deadline:
+            expanded, chessboard, side, outcome, path_boards = self.select_leaf(pos_counts)
+            if outcome is None:
+                outcome = playout(self, chessboard, pos_counts, side)
+            self.tree.update_value(expanded, outcome, self.cur)
+            for chessboard in path_boards:
+                pos_counts.pop(chessboard)
+            n_done += 1
+            if deadline is not None and self.early_stop and n_done % EARLY_STOP_INTERVAL == 0 and self.is_decided(deadline, n_done/(time()-then)):
+                break
+
+    def is_decided(self, deadline, rate):
+        '''Whether the most visited move at self.cur would stay the most visited even if every rollout that fits before deadline, at rate rollouts per second, went to the runner-up'''
+        tree = self.tree
+        children = tree.children(self.cur)
+        if len(children) == 1 and not self.untried_moves(self.cur, self.cur_board, self.side):
+            return True
+        # Moves that haven't been tried yet count as having no visits
+        visits = sorted(tree.visits[children], reverse=True) + [0, 0]
+        return visits[0] - visits[1] > rate*(deadline - time())
+
+    def do_leaf_parallel_rollouts(self, pos_counts, deadline=None):
+        '''Tree-parallel search: selects a batch of one leaf per worker, sends their rollouts to a process pool and backs up each result as it comes back. Nodes with rollouts in flight carry a virtual loss, so that each selection in a batch goes down a different path.'''
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+        tree = self.tree
+        then = time()
+        n_done = 0
+        # As in do_rollouts(), at least one batch is run even if the deadline
+        # has passed
+        while n_done < self.n_rollouts if deadline is None else n_done == 0 or time() < deadline:
+            n_batch = self.workers if deadline is not None else min(self.workers, self.n_rollouts - n_done)
+            futures = {}
+            for i in range(n_batch):
+                expanded, chessboard, side, outcome, path_boards = self.select_leaf(pos_counts)
+                if outcome is None:
+                    tree.add_virtual_loss(expanded, self.cur, 1)
+                    # The job is pickled later on, so it needs its own copy of
+                    # the game history
+                    future = self.executor.submit(playout, self, chessboard, copy.deepcopy(pos_counts), side, random.getrandbits(32))
+                    futures[future] = expanded
+                else:
+                    tree.update_value(expanded, outcome, self.cur)
+                for chessboard in path_boards:
+                    pos_counts.pop(chessboard)
+            for future in concurrent.futures.as_completed(futures):
+                expanded = futures[future]
+                tree.add_virtual_loss(expanded, self.cur, -1)
+                tree.update_value(expanded, future.result(), self.cur)
+            n_done += n_batch
+            if deadline is not None and self.early_stop and self.is_decided(deadline, n_done/(time()-then)):
+                break
+
+    def do_parallel_rollouts(self, pos_counts, deadline=None):
+        '''Root-parallel search: splits the rollouts between worker processes (or gives each of them the same deadline), each of which grows an independent tree from self.cur with its own random seed, then merges the visits and values they found for each move at self.cur into self.tree.'''
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+        jobs = []
+        for worker in range(self.workers):
+            n_rollouts = self.n_rollouts//self.workers + (worker < self.n_rollouts % self.workers)
+            jobs.append((self, self.cur_board, pos_counts, n_rollouts, random.getrandbits(32), deadline))
+        tree = self.tree
+        for codes, visits, values in self.pool.starmap(grow_tree, jobs):
+            for code, child_visits, child_value in zip(codes, visits, values):
+                child = self.get_child(self.cur, board.unpack_move(int(code)))
+                # A node's value is weighted by its visits in its parent's
+                # value, so the merged value is the visit-weighted mean
+                total_visits = tree.visits[child] + child_visits
+                if total_visits:
+                    tree.values[child] = (tree.values[child]*tree.visits[child] + child_value*child_visits)/total_visits
+                tree.visits[child] = total_visits
+                tree.visits[self.cur] += child_visits
+        children = np.array(tree.children(self.cur), dtype=np.int32)
+        tree.values[self.cur] = np.dot(tree.values[children], tree.visits[children])
+
+    def best_move(self):
+        tree = self.tree
+        children = tree.children(self.cur)
+        if self.early_stop and self.time_limit:
+            # Early stopping only makes sure of which move has the most visits
+            return tree.move(max(children, key=lambda child: tree.visits[child]))
+        best_child = children[0]
+        for child in children[1:]:
+            if self.side*(tree.values[child]-tree.values[best_child]) > 0:
+                best_child = child
+            
+        return tree.move(best_child)
+
+    def untried_moves(self, node, chessboard, side):
+        '''Returns the stack of moves at node (where side is to move) that haven't been expanded yet, in random order. It's generated the first time node is visited, leaving out any moves that already have children, and expansion pops from it.'''
+        untried = self.tree.untried.get(node)
+        if untried is None:
+            tried = set(int(self.tree.moves[child]) for child in self.tree.children(node))
+            untried = [move for move in self.get_all_moves(chessboard, side) if board.pack_move(move) not in tried]
+            random.shuffle(untried)
+            self.tree.untried[node] = untried
+        return untried
+
+
+def playout(searcher, chessboard, pos_counts, side, seed=None):
+    '''Plays out the game from chessboard, where side is to move, with searcher's rollout policy, and returns the outcome: +100000 for a White win, -100000 for a Black win, 0 for a draw, or the heuristic evaluation if the rollout is cut off at searcher.max_depth. It's a plain function so that it can be sent to worker processes, which are given their own seed.
+    The game is over under the same conditions as in get_result(), but checked without it, or once it's been adjudicated as won (see MCTS.adjudicate_eval): the moves are made in place on a single scratch board, and rather than being pushed onto pos_counts, the keys of the positions reached are kept in a list that's only searched back to the last capture or pawn move.'''
+    if seed is not None:
+        random.seed(seed)
+    chessboard = board.Board(bytearray(chessboard.squares), chessboard.key, chessboard.score, chessboard.halfmove)
+    board.get_bitboards(chessboard)
+    keys = []
+    # How many plies in a row the evaluation has been beyond the adjudication
+    # threshold, negative if in Black's favor
+    lead_plies = 0
+    depth = 0
+    while True:
+        cutoff = searcher.max_depth != 0 and depth == searcher.max_depth
+        # At the cutoff, all that matters is whether there are any moves
+        move = pick_playout_move(chessboard, side, searcher.use_heuristic and not cutoff)
+        if move is None:
+            if board.test_check_bitboard(chessboard, side):
+                return -side*100000
+            elif side == 1 and searcher.variant == 'horde':
+                return -100000
+            return 0
+        # A position can only have occurred before if there's been no capture
+        # or pawn move since, which takes at least four moves
+        if chessboard.halfmove >= 4:
+            key = chessboard.key
+            count = keys[max(0, len(keys) - 1 - chessboard.halfmove):].count(key)
+            if chessboard.halfmove >= len(keys):
+                count += pos_counts[key]
+            if count >= 3:
+                return 0
+        if chessboard.halfmove >= board.FIFTY_MOVE_PLIES:
+            return 0
+        # Material only changes with captures and promotions, which reset the
+        # halfmove clock
+        if (chessboard.halfmove == 0 or depth == 0) and searcher.variant != 'horde' \
+                and board.insufficient_material(chessboard):
+            return 0
+        if pos_counts.positions + depth >= 200:
+            return 0
+        if searcher.adjudicate_eval:
+            evaluation = heuristic.evaluate(chessboard)
+            if evaluation > searcher.adjudicate_eval:
+                lead_plies = max(lead_plies, 0) + 1
+            elif evaluation < -searcher.adjudicate_eval:
+                lead_plies = min(lead_plies, 0) - 1
+            else:
+                lead_plies = 0
+            if abs(lead_plies) >= searcher.adjudicate_plies:
+                return 100000 if lead_plies > 0 else -100000
+        if cutoff:
+            return heuristic.evaluate(chessboard, mobility=searcher.mobility)
+        board.play_move(chessboard, board.SQUARE_COORDS[move[0]], board.SQUARE_COORDS[move[1]])
+        keys.append(chessboard.key)
+        side = -side
+        depth += 1
+
+def pick_playout_move(chessboard, side, use_heuristic):
+    '''Picks a legal move for side as (start, finish) square indices, or returns None if there aren't any. Without the heuristic this is uniformly random; with it, it's the best capture by MVV-LVA, or a random quiet move if there are no captures. Pseudo-legal moves are only checked for legality once picked, so usually just one of them is.'''
+    moves = board.get_pseudo_legal_moves(chessboard, side)
+    if use_heuristic:
+        coords = board.SQUARE_COORDS
+        captures, quiets = heuristic.order_captures(chessboard, [(coords[start], coords[finish]) for start, finish in moves])
+        for start, finish in captures:
+            move = (start[0]*8 + start[1], finish[0]*8 + finish[1])
+            if not board.leaves_in_check(chessboard, side, *move):
+                return move
+        moves = [(start[0]*8 + start[1], finish[0]*8 + finish[1]) for start, finish in quiets]
+    while moves:
+        i = random.randrange(len(moves))
+        move = moves[i]
+        if not board.leaves_in_check(chessboard, side, *move):
+            return move
+        moves[i] = moves[-1]
+        moves.pop()
+    return None
+
+def grow_tree(searcher, chessboard, pos_counts, n_rollouts, seed, deadline=None):
+    '''Runs n_rollouts (or until deadline) of searcher's search in a new tree rooted at chessboard, and returns the packed moves, visits and values of the root's children. This is the job each worker process does in root-parallel search.'''
+    random.seed(seed)
+    searcher.tree = Tree(chessboard)
+    searcher.cur = Tree.ROOT
+    searcher.cur_board = chessboard
+    searcher.do_rollouts(pos_counts, n_rollouts, deadline)
+    children = searcher.tree.children(Tree.ROOT)
+    return searcher.tree.moves[children], searcher.tree.visits[children], searcher.tree.values[children]
+
+
+# Trees are saved as this header, followed by each of the arrays in
+# TREE_FILE_ARRAYS, with room for the nodes in use and as many again. The
+# version changes whenever the layout does.
+TREE_FILE_MAGIC = b'MCTSTREE'
+TREE_FILE_VERSION = 2
+# Magic, version, number of nodes, root board and its halfmove clock, and the
+# number of nodes the arrays have room for. In version 1 that last field was
+# padding, and the arrays only had room for the nodes in use.
+TREE_FILE_HEADER = struct.Struct('<8sIQ{}sII'.format(board.NUM_DIGITS))
+TREE_FILE_ARRAYS = (('values', '<f8'), ('visits', '<i4'), ('parents', '<i4'), ('first_child', '<i4'), ('next_sibling', '<i4'), ('moves', '<i2'))
+
+class Tree(object):
+    '''MCTS game tree stored as parallel NumPy arrays, indexed by node number, rather than as one object per node. Each node's children are linked through first_child and next_sibling, and the move leading to it is kept packed; boards aren't stored at all, but rebuilt from root_board by making the moves on the path to a node.'''
+
+    ROOT = 0
+    NONE = -1
+    # Each per-node array, and what it's filled with for nodes not in use
+    ARRAYS = (('visits', 0), ('values', 0), ('parents', NONE), ('first_child', NONE), ('next_sibling', NONE), ('moves', NONE), ('virtual_loss', 0))
+
+    def __init__(self, root_board, capacity=1024):
+        self.root_board = root_board
+        self.size = 1
+        self.visits = np.zeros(capacity, dtype=np.int32)
+        # Same meaning as Node.value used to have: a leaf's last rollout
+        # outcome, or the visit-weighted sum of its children's values
+        self.values = np.zeros(capacity)
+        self.parents = np.full(capacity, self.NONE, dtype=np.int32)
+        self.first_child = np.full(capacity, self.NONE, dtype=np.int32)
+        self.next_sibling = np.full(capacity, self.NONE, dtype=np.int32)
+        self.moves = np.full(capacity, self.NONE, dtype=np.int16)
+        # How many rollouts through each node are still running in leaf-parallel
+        # search
+        self.virtual_loss = np.zeros(capacity, dtype=np.int32)
+        # Each node's stack of unexpanded moves, from when MCTS first visits it
+        self.untried = {}
+
+    def __getstate__(self):
+        # Only pickle the part of each array that's in use. The untried move
+        # stacks aren't saved, since they're cheap to regenerate, and nor are
+        # virtual losses, which only last during a search.
+        state = self.__dict__.copy()
+        for name in ('visits', 'values', 'parents', 'first_child', 'next_sibling', 'moves'):
+            state[name] = state[name][:self.size]
+        del state['untried']
+        del state['virtual_loss']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.untried = {}
+        self.virtual_loss = np.zeros(self.size, dtype=np.int32)
+
+    def save(self, path):
+        '''Writes the tree to path in the flat binary format that load() reads'''
+        # Spare room for as many nodes again, the same as grow() would make
+        capacity = max(2*self.size, 1024)
+        fills = dict(self.ARRAYS)
+        # A tree loaded from path may still be mapped from it, so write a new
+        # file and move it into place rather than overwriting this one
+        with open(path + '.tmp', 'wb') as file:
+            file.write(TREE_FILE_HEADER.pack(TREE_FILE_MAGIC, TREE_FILE_VERSION, self.size, bytes(self.root_board.squares), self.root_board.halfmove, capacity))
+            for name, dtype in TREE_FILE_ARRAYS:
+                file.write(getattr(self, name)[:self.size].astype(dtype).tobytes())
+                file.write(np.full(capacity - self.size, fills[name], dtype=dtype).tobytes())
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        '''Reads a tree written by save(). The file is memory-mapped rather than read, and the arrays are views of the mapping, so loading takes the same time however big the tree is, and only the parts of it that are used get read from disk. The mapping is copy-on-write: the tree can be searched and changed, but only save() changes the file. New nodes go in the file's spare room, so the arrays are only copied into memory if the tree outgrows it, which grow() does for any tree.'''
+        with open(path, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, version, size, squares, halfmove, capacity = TREE_FILE_HEADER.unpack_from(buffer)
+        if magic != TREE_FILE_MAGIC:
+            raise ValueError('{} is not a saved MCTS tree'.format(path))
+        if version not in (1, TREE_FILE_VERSION):
+            raise ValueError('{} is a version {} MCTS tree, but only versions 1 and {} can be read'.format(path, version, TREE_FILE_VERSION))
+        if version == 1:
+            capacity = size
+        tree = cls.__new__(cls)
+        tree.root_board = board.Board(bytearray(squares), halfmove=halfmove)
+        tree.size = size
+        offset = TREE_FILE_HEADER.size
+        for name, dtype in TREE_FILE_ARRAYS:
+            array = np.frombuffer(buffer, dtype=dtype, count=capacity, offset=offset)
+            setattr(tree, name, array)
+            offset += array.nbytes
+        tree.virtual_loss = np.zeros(capacity, dtype=np.int32)
+        tree.untried = {}
+        return tree
+
+    @classmethod
+    def from_nodes(cls, root):
+        '''Converts a tree saved as a graph of Node objects'''
+        chessboard = root.chessboard
+        # Even older saves store each board as a base-13 integer
+        if not isinstance(chessboard, board.Board):
+            chessboard = board.from_int(chessboard)
+        tree = cls(chessboard)
+        stack = [(root, cls.ROOT)]
+        while stack:
+            node, index = stack.pop()
+            tree.visits[index] = node.visits
+            # Nodes that were added but never visited still have a NaN value
+            tree.values[index] = 0 if math.isnan(node.value) else node.value
+            for move, child in node.children.items():
+                stack.append((child, tree.add_child(index, move)))
+        return tree
+
+    def grow(self):
+        capacity = 2*len(self.visits)
+        for name, fill in self.ARRAYS:
+            old = getattr(self, name)
+            new = np.full(capacity, fill, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def memory(self):
+        '''Approximate bytes used by the tree: its arrays, and its untried move stacks (not counting the moves, which are mostly shared)'''
+        total = sum(getattr(self, name).nbytes for name, fill in self.ARRAYS)
+        total += sys.getsizeof(self.untried) + sum(sys.getsizeof(untried) for untried in self.untried.values())
+        return total
+
+    def subtree_mask(self, roots):
+        '''Given a boolean mask of nodes, returns the mask of those nodes and all of their descendants'''
+        parents = self.parents[:self.size]
+        has_parent = parents != self.NONE
+        mask = roots.copy()
+        # Each pass reaches one level further down
+        while True:
+            new_mask = mask.copy()
+            new_mask[has_parent] |= mask[parents[has_parent]]
+            if np.array_equal(new_mask, mask):
+                return mask
+            mask = new_mask
+
+    def keep(self, kept):
+        '''Removes every node not in the boolean mask kept, which has to include all the ancestors of the nodes in it, and renumbers the rest in the same order. Returns an array mapping old node numbers to new ones (NONE for removed nodes).'''
+        old_nodes = np.flatnonzero(kept)
+        size = len(old_nodes)
+        new_numbers = np.full(self.size + 1, self.NONE, dtype=np.int32)
+        new_numbers[old_nodes] = np.arange(size)
+        # The extra last entry maps NONE to NONE
+        parents = new_numbers[self.parents[old_nodes]]
+        capacity = len(self.visits)
+        for name, fill in self.ARRAYS:
+            old = getattr(self, name)
+            new = np.full(capacity, fill, dtype=old.dtype)
+            new[:size] = old[old_nodes]
+            setattr(self, name, new)
+        self.parents[:size] = parents
+        self.first_child[:size] = self.NONE
+        self.next_sibling[:size] = self.NONE
+        # Relink the children: sort them by parent, so that each parent's
+        # children are consecutive, and link each to the next
+        children = np.flatnonzero(parents != self.NONE)
+        children = children[np.argsort(parents[children], kind='stable')]
+        child_parents = parents[children]
+        same_parent = child_parents[1:] == child_parents[:-1]
+        self.next_sibling[children[:-1][same_parent]] = children[1:][same_parent]
+        first = np.ones(len(children), dtype=bool)
+        first[1:] = ~same_parent
+        self.first_child[child_parents[first]] = children[first]
+        self.untried = {int(new_numbers[node]): untried for node, untried in self.untried.items() if kept[node]}
+        self.size = size
+        return new_numbers[:-1]
+
+    def reroot(self, node, chessboard):
+        '''Makes node, whose board is chessboard, the root, throwing away everything that isn't below it'''
+        self.keep(self.subtree_mask(np.arange(self.size) == node))
+        # node has the lowest number in its subtree, so it's now ROOT
+        self.parents[self.ROOT] = self.NONE
+        self.moves[self.ROOT] = self.NONE
+        self.root_board = chessboard
+
+    def add_child(self, parent, move):
+        '''Adds a node for the position after move is made at parent, and returns its index'''
+        if self.size == len(self.visits):
+            self.grow()
+        node = self.size
+        self.size += 1
+        self.parents[node] = parent
+        self.moves[node] = board.pack_move(move)
+        self.next_sibling[node] = self.first_child[parent]
+        self.first_child[parent] = node
+        return node
+
+    def children(self, node):
+        children = []
+        child = self.first_child[node]
+        while child != self.NONE:
+            children.append(child)
+            child = self.next_sibling[child]
+        return children
+
+    def child(self, node, move):
+        '''Returns the index of the child reached from node by move, or NONE if it hasn't been added'''
+        code = board.pack_move(move)
+        for child in self.children(node):
+            if self.moves[child] == code:
+                return child
+        return self.NONE
+
+    def move(self, node):
+        return board.unpack_move(int(self.moves[node]))
+
+    def board(self, node):
+        '''Rebuilds the board at node from the root'''
+        path = []
+        while node != self.ROOT:
+            path.append(self.move(node))
+            node = self.parents[node]
+        chessboard = self.root_board
+        for move in reversed(path):
+            chessboard = board.make_move(chessboard, *move)
+        return chessboard
+
+    def select_child(self, node, side, ucb_const):
+        '''Picks the child of node (where side is to move) with the best UCB weight; children that have never been visited come first. The rollout in progress already counts as a visit to node, and each rollout still running through a node counts as a visit that side lost.'''
+        children = np.array(self.children(node))
+        in_flight = self.virtual_loss[children]
+        with np.errstate(divide='ignore'):
+            explore_vals = ucb_const * np.sqrt(math.log(self.visits[node] + self.virtual_loss[node] + 1)/(self.visits[children] + in_flight))
+        return children[np.argmax(side*self.values[children] - VIRTUAL_LOSS*in_flight + explore_vals)]
+
+    def add_virtual_loss(self, node, cur, amount):
+        '''Adds amount to the number of rollouts in flight through node and its ancestors up to cur'''
+        while True:
+            self.virtual_loss[node] += amount
+            if node == cur or self.parents[node] == self.NONE:
+                break
+            node = self.parents[node]
+
+    def update_value(self, node, outcome, cur):
+        '''Counts a rollout from node in the visits and values of node and its ancestors up to cur, in a single pass up the tree. Each parent's value is the visit-weighted sum of its children's, so rather than summing over all of its children again, only the change in the one child on the path is added.
+        outcome: +100000 for a first player win, -100000 for a second player win, 0 for a draw, or some heuristic evaluation in between'''
+        old_value = self.values[node]
+        old_visits = self.visits[node]
+        self.visits[node] += 1
+        if self.first_child[node] == self.NONE:
+            self.values[node] = outcome
+        while node != cur and self.parents[node] != self.NONE:
+            parent = self.parents[node]
+            parent_value = self.values[parent]
+            parent_visits = self.visits[parent]
+            self.visits[parent] += 1
+            if self.first_child[parent] == node and self.next_sibling[node] == self.NONE:
+                # If node is the only child, the parent's value may still be
+                # its own rollout outcome rather than a sum
+                self.values[parent] = self.values[node]*self.visits[node]
+            else:
+                self.values[parent] += self.values[node]*self.visits[node] - old_value*old_visits
+            old_value, old_visits = parent_value, parent_visits
+            node = parent
+
+    def refresh_values(self, node):
+        '''Recomputes the values of node's ancestors from all of their children. update_value() stops at MCTS's current node, so the nodes above it fall behind as a game goes on; this brings them up to date once it's over.'''
+        node = self.parents[node]
+        while node != self.NONE:
+            children = np.array(self.children(node), dtype=np.int32)
+            self.values[node] = np.dot(self.values[children], self.visits[children])
+            node = self.parents[node]
 
 
 class Node(object):
-    """Node used in MCTS"""
+    """Node of the object-per-node tree that MCTS used before Tree. It's only
+    kept so that trees saved in that format can still be unpickled and then
+    converted with Tree.from_nodes()."""
     
     def __init__(self, chessboard, parent_node, ucb_const):
-        """Constructor for a new node representing game state
-        state. parent_node is the Node that is the parent of this
-        one in the MCTS tree. """
         self.chessboard = chessboard
         self.parent = parent_node
-        self.children = {} # maps moves (keys) to Nodes (values); if you use it differently, you must also change addMove
+        self.children = {} # maps moves (keys) to Nodes (values)
         self.ucb_const = ucb_const
         self.visits = 0
         self.value = float("nan")
-        # Note: you may add additional fields if needed
-        
-    def add_move(self, move):
-        """
-        Adds a new node for the child resulting from move if one doesn't already exist.
-        Returns true if a new node was added, false otherwise.
-        """
-        if move not in self.children:
-            chessboard = board.make_move(self.chessboard, move[0], move[1])
-            self.children[move] = Node(chessboard, self, self.ucb_const)
-            return True
-        return False
-    
-    def get_value(self):
-        """
-        Gets the value estimate for the current node. Value estimates should correspond
-        to the win percentage for the player at this node (accounting for draws as in 
-        the project description).
-        """
-        return self.value
-
-    def update_value(self, outcome, cur, pos_counts):
-        """Updates the value estimate for the node's state.
-        outcome: +100000 for a first player win, -100000 for a second player win, 0 for a draw, or some heuristic evaluation in between"""
-        # NOTE: which outcome is preferred depends on self.state.turn()
-        self.value = 0
-        if len(self.children) == 0:
-            self.value = outcome
-        for child in self.children.values():
-            self.value += child.value * child.visits
-        if self.parent and self is not cur:
-            pos_counts[self.chessboard] -= 1
-            self.parent.update_value(0, cur, pos_counts)
-
-    def UCB_weight(self, side):
-        """Weight from the UCB formula used by parent to select a child.
-        This node will be selected by parent with probability proportional
-        to its weight."""
-        if self.parent is None:
-            raise Exception("no")
-        explore_val = self.ucb_const * math.sqrt(math.log(self.parent.visits)/self.visits) * -side
-        return self.value + explore_val
@@ -1,34 +1,198 @@
 #import chess
+import multiprocessing
+
 import numpy as np
 
 import agent
 import board
 import heuristic
 from time import time
+from transposition import TranspositionTable, EXACT, LOWER, UPPER
+
+# Deepest iteration of an iterative deepening search
+MAX_SEARCH_DEPTH = 64
+# Null-move pruning and late move reductions are only tried with at least this
+# many plies left to search
+REDUCTION_MIN_DEPTH = 3
+# How many plies shallower the search after a null move is
+NULL_MOVE_REDUCTION = 2
+# How many moves at a node are searched to full depth before quiet moves start
+# being reduced by a ply
+LMR_FULL_DEPTH_MOVES = 3
+# Scores are floats, so a null window is this narrow rather than empty
+NULL_WINDOW = 0.01
+# Each iteration of iterative deepening first searches with a window this far
+# either side of the previous iteration's score, widening it by a factor of
+# ASPIRATION_GROWTH each time the score falls outside it, and past
+# MAX_ASPIRATION_WINDOW giving up on it
+ASPIRATION_WINDOW = 0.25
+ASPIRATION_GROWTH = 4
+MAX_ASPIRATION_WINDOW = 50
+
+# In a Lazy SMP helper process, the flag the main search sets once it's done
+# (see init_helper())
+helper_stop = None
+
+class SearchTimeout(Exception):
+    """Raised inside alpha_beta() when the time or node budget runs out, or a helper is told to stop"""
+
 class Minimax(agent.Agent):
 
-    def __init__(self, side, depth, variant):
+    def __init__(self, side, depth, variant, backend='array', hash_mb=16, time_limit=0, node_limit=0, mobility=False, threads=1, parallel='smp', noise=True, null_move=False, lmr=False):
         self.depth = depth
         self.side = side
         self.variant = variant
+        # Whether leaf evaluations include the (expensive) mobility term
+        self.mobility = mobility
+        self.backend = backend
+        self.get_all_moves, self.test_check = board.BACKENDS[backend]
+        # With more than one thread, either helper processes search the same
+        # position alongside get_move() and share what they find through the
+        # table (Lazy SMP, 'smp'), or the moves at the root after the first are
+        # split between processes ('split'). Either way the table lives in
+        # shared memory.
+        self.threads = threads
+        self.parallel = parallel
+        # Whether a little random noise is added to move values, so that equal
+        # moves aren't always picked in the same order
+        self.noise = noise
+        # Whether to prune with null moves (letting the other side move twice)
+        # and to search late quiet moves a ply shallower (late move reductions)
+        self.null_move = null_move
+        self.lmr = lmr
+        self.pool = None
+        self.helper_stop = None
+        # Set in helper processes, which stop searching once it's set
+        self.stop = None
+        self.helper_nodes = 0
+        # Kept for the whole game, so later moves reuse earlier searches
+        self.table = TranspositionTable(hash_mb, shared=threads > 1) if hash_mb else None
+        # Per-move budgets (seconds and nodes); if either is set, get_move()
+        # searches iteratively deeper instead of to a fixed depth
+        self.time_limit = time_limit
+        self.node_limit = node_limit
+        self.deadline = None
+        self.search_depth = depth
+        self.pv_lines = [[] for i in range(depth+1)]
+        self.pv_moves = {}
+        self.reset_ordering()
+        self.nodes = 0
+
+    def __getstate__(self):
+        # Helper processes are sent a copy of the agent without the helper
+        # processes
+        state = self.__dict__.copy()
+        del state['pool']
+        del state['helper_stop']
+        return state
 
     def get_move(self,chessboard, pos_counts):
         # then = time()
-        result = self.alpha_beta(chessboard, pos_counts, 0, -100000, 100000, self.side)[0]
+        self.nodes = 0
+        self.reset_ordering()
+        # Helpers only help through the table
+        helpers = self.start_helpers(chessboard, pos_counts) if self.threads > 1 and self.parallel == 'smp' and self.table is not None else None
+        try:
+            if self.time_limit or self.node_limit:
+                result = self.iterative_deepening(chessboard, pos_counts)
+            else:
+                self.search_depth = self.depth
+                self.pv_lines = [[] for i in range(self.depth+1)]
+                result = self.alpha_beta(chessboard, pos_counts, 0, -100000, 100000, self.side)[0]
+        finally:
+            if helpers is not None:
+                self.helper_stop.value = 1
+                self.helper_nodes = sum(helpers.get())
         # now = time()-then
         # print("get_move took " + str(now) + " seconds")
         return result
 
-    def order_moves_naive(self, chessboard, side):
-        '''Given a board and a side, naively orders the set of all possible moves based solely on whether or not they involve the capture of a piece, and if so, how much the piece is worth.'''
-        moves = board.get_all_moves(chessboard, side)
-        
-        moves_and_values = [(move, heuristic.evaluate(board.make_move(chessboard, move[0], move[1]))) for move in moves]
-        moves_and_values.sort(reverse=(side==1), key=lambda x: x[1])
-        return [tup[0] for tup in moves_and_values]
+    def start_helpers(self, chessboard, pos_counts):
+        '''Starts a search of chessboard in each of threads-1 helper processes (see helper_search()), and returns the pending result of their node counts'''
+        if self.pool is None:
+            self.helper_stop = multiprocessing.RawValue('b', 0)
+            self.pool = multiprocessing.Pool(self.threads-1, init_helper, (self.helper_stop,))
+        self.helper_stop.value = 0
+        jobs = [(self, chessboard, pos_counts, helper, np.random.randint(2**31)) for helper in range(1, self.threads)]
+        return self.pool.starmap_async(helper_search, jobs)
+
+    def iterative_deepening(self, chessboard, pos_counts):
+        '''Searches to depth 1, 2, 3... until the time or node budget runs out, and returns the best move from the deepest completed search. Each search tries the previous one's principal variation first, and after the first, searches with an aspiration window around its score.'''
+        self.deadline = time() + self.time_limit if self.time_limit else None
+        self.pv_moves = {}
+        best_move = None
+        score = None
+        try:
+            for depth in range(1, MAX_SEARCH_DEPTH+1):
+                self.search_depth = depth
+                best_move, score = self.aspiration_search(chessboard, pos_counts, score)
+                self.set_pv(chessboard, self.side, self.pv_lines[0])
+        except SearchTimeout:
+            pass
+        finally:
+            self.deadline = None
+        if best_move is None:
+            # Not even depth 1 finished
+            best_move = self.get_all_moves(chessboard, self.side)[0]
+        return best_move
+
+    def aspiration_search(self, chessboard, pos_counts, guess):
+        '''Searches the root to self.search_depth and returns the best move and its value. If there's a guess at the value, the search starts with a narrow window around it (see ASPIRATION_WINDOW), and is repeated with a wider window on whichever side the value falls outside it, until it doesn't.'''
+        delta = ASPIRATION_WINDOW
+        while True:
+            if guess is None or delta > MAX_ASPIRATION_WINDOW:
+                alpha, beta = -100000, 100000
+            else:
+                alpha, beta = guess - delta, guess + delta
+            self.pv_lines = [[] for i in range(self.search_depth+1)]
+            best_move = self.alpha_beta(chessboard, pos_counts, 0, alpha, beta, self.side)
+            # A score on the window's edge is only a bound, and the move that
+            # got it may not be the best
+            if (best_move[1] <= alpha and alpha > -100000) or (best_move[1] >= beta and beta < 100000):
+                delta *= ASPIRATION_GROWTH
+            else:
+                return best_move
+
+    def set_pv(self, chessboard, side, pv):
+        '''Remembers the move to try first in each position along the principal variation pv'''
+        self.pv_moves = {}
+        for move in pv:
+            if move is None:
+                break
+            self.pv_moves[self.table_key(chessboard, side)] = move
+            chessboard = board.make_move(chessboard, move[0], move[1])
+            side *= -1
+
+    def table_key(self, chessboard, side):
+        return chessboard.key ^ (board.ZOBRIST_BLACK_TO_MOVE if side == -1 else 0)
+
+    def order_moves(self, chessboard, side, depth, moves):
+        '''Given a board, a side and its moves, orders the moves without evaluating any of the resulting boards: captures first by MVV-LVA, then the killer moves for this depth, then other quiet moves by their history score. alpha_beta() puts the hash and PV moves in front of these.'''
+        captures, quiets = heuristic.order_captures(chessboard, moves)
+        killers = [move for move in self.killers[depth] if move in quiets]
+        history = self.history
+        offset = 4096 if side == 1 else 0
+        quiets = [move for move in quiets if move not in killers]
+        quiets.sort(reverse=True, key=lambda move: history[offset + board.pack_move(move)])
+        return captures + killers + quiets
 
-    def alpha_beta(self, chessboard, pos_counts, depth, alpha, beta, side):
-        '''Given a board and a move, returns an evaluation for that move by recursing over every possible move in each state until the depth limit is reached, then using the evaluate() function and passing the values back up through minimax with alpha-beta pruning.'''
+    def record_cutoff(self, chessboard, move, depth, side):
+        '''Updates the killer moves and history scores after move caused a cutoff'''
+        if heuristic.mvv_lva(chessboard, move) is not None:
+            return
+        killers = self.killers[depth]
+        if move not in killers:
+            self.killers[depth] = [move] + killers[:1]
+        offset = 4096 if side == 1 else 0
+        self.history[offset + board.pack_move(move)] += (self.search_depth - depth)**2
+
+    def reset_ordering(self):
+        self.killers = [[] for i in range(MAX_SEARCH_DEPTH+1)]
+        # Indexed by packed move, with White's moves in the upper half
+        self.history = [0]*8192
+
+    def alpha_beta(self, chessboard, pos_counts, depth, alpha, beta, side, allow_null=True):
+        '''Given a board and the side to move, returns the best move and its value by recursing over every possible move in each state until the depth limit is reached, then using the evaluate() function and passing the values back up with alpha-beta pruning. It's a negamax search: values are from the point of view of side, and so are the bounds alpha and beta. allow_null is False right after a null move, so that there aren't two in a row.'''
         # if not board.find_king(chessboard, 1) and self.variant != 'horde':
         #     return (None, -10000)
         # elif not board.find_king(chessboard, -1):
@@ -47,43 +211,171 @@ class Minimax(agent.Agent):
         #             return (None, 10000)
         #         else:
         #             return (None, 0)
-        result = board.get_result(chessboard, pos_counts, self.variant, side, False)
+        self.nodes += 1
+        if self.node_limit and self.nodes > self.node_limit:
+            raise SearchTimeout()
+        if self.deadline is not None and self.nodes % 64 == 0 and time() > self.deadline:
+            raise SearchTimeout()
+        if self.stop is not None and self.nodes % 64 == 0 and self.stop.value:
+            raise SearchTimeout()
+        self.pv_lines[depth] = []
+        if depth == self.search_depth:
+            # get_result() only needs to know whether there are any moves
+            moves = None
+        else:
+            moves = self.get_all_moves(chessboard, side)
+        result = board.get_result(chessboard, pos_counts, self.variant, -side, False, moves, self.backend)
         if result is not None:
             # Return a large number since we might be stopping early and doing
             # a heuristic evaluation, which might be bigger than 1 or -1
-            return (None, result*100000)
-        elif depth == self.depth:
-            value = heuristic.evaluate(chessboard)
+            return (None, side*result*100000)
+        elif depth == self.search_depth:
+            value = side*heuristic.evaluate(chessboard, mobility=self.mobility)
             return (None, value)
-        ordered_moves = self.order_moves_naive(chessboard, side)
-        if side == 1:
-            best_move = (None, -100000)
-            for move in ordered_moves:
-                new_board = board.make_move(chessboard, move[0], move[1])
-                pos_counts[new_board] += 1
-                _, move_value = self.alpha_beta(new_board, pos_counts, depth+1, alpha, beta, -1)
-                noise = np.random.normal(scale=0.05)
-                move_value += noise
-                pos_counts[new_board] -= 1
-                if move_value > best_move[1]:
-                    best_move = (move, move_value)
-                alpha = max(alpha, best_move[1])
-                if beta <= best_move[1]:
-                    return best_move
-            return best_move
+        # Probe the transposition table; the root always gets searched, since
+        # we need a legal move out of it
+        key = self.table_key(chessboard, side)
+        entry = self.table.probe(key) if self.table is not None else None
+        hash_move = None
+        if entry is not None:
+            entry_depth, bound, score, hash_move = entry
+            if depth > 0 and entry_depth >= self.search_depth - depth:
+                if bound == EXACT \
+                        or (bound == LOWER and score >= beta) \
+                        or (bound == UPPER and score <= alpha):
+                    if hash_move is not None:
+                        self.pv_lines[depth] = [hash_move]
+                    return (hash_move, score)
+        orig_alpha = alpha
+        # Neither the null move nor reductions are safe in check, and neither
+        # is used at the root
+        selective = (self.null_move or self.lmr) and depth > 0 and self.search_depth - depth >= REDUCTION_MIN_DEPTH \
+            and not self.test_check(chessboard, side)
+        # A null move is a pass, so it's left out where passing might be the
+        # best move (zugzwang), or where it would have to clear an en passant
+        # square
+        if selective and self.null_move and allow_null and beta < 100000 and board.has_non_pawn_material(chessboard, side) \
+                and board.get_ep_square(chessboard) == (8, 8):
+            # If the other side can't get back below beta even with two moves
+            # in a row, a real move won't let it either
+            null_depth = depth + 1 + NULL_MOVE_REDUCTION
+            if -self.alpha_beta(chessboard, pos_counts, null_depth, -beta, -beta + NULL_WINDOW, -side, False)[1] >= beta:
+                return (None, beta)
+        ordered_moves = self.order_moves(chessboard, side, depth, moves)
+        # Try the best move from last time first, and before that the move from
+        # the previous iteration's principal variation
+        for first_move in (hash_move, self.pv_moves.get(key)):
+            if first_move in ordered_moves:
+                ordered_moves.remove(first_move)
+                ordered_moves.insert(0, first_move)
+        if depth == 0 and self.threads > 1 and self.parallel == 'split':
+            best_move = self.split_root(chessboard, pos_counts, ordered_moves, alpha, beta, side)
         else:
-            best_move = (None, 100000)
-            for move in ordered_moves:
-                new_board = board.make_move(chessboard, move[0], move[1])
-                pos_counts[new_board] += 1
-                _, move_value = self.alpha_beta(new_board, pos_counts, depth+1, alpha, beta, 1)
-                noise = np.random.normal(scale=0.05)
-                move_value += noise
-                pos_counts[new_board] -= 1
-                if move_value < best_move[1]:
-                    best_move = (move, move_value)
-                beta = min(beta, best_move[1])
-                if alpha >= best_move[1]:
-                    return best_move
+            best_move = self.search_moves(chessboard, pos_counts, ordered_moves, depth, alpha, beta, side, selective and self.lmr)
+        if self.table is not None:
+            if best_move[1] <= orig_alpha:
+                bound = UPPER
+            elif best_move[1] >= beta:
+                bound = LOWER
+            else:
+                bound = EXACT
+            self.table.store(key, self.search_depth - depth, bound, best_move[1], best_move[0])
+        return best_move
+
+    def split_root(self, chessboard, pos_counts, ordered_moves, alpha, beta, side):
+        ''' Root-split search: searches the first move serially to get a bound, then the other moves in parallel in a process pool, each with that bound (the young brothers wait for the eldest), and goes through their values in order the way search_moves() would. Without noise, it picks the same move as a serial search.'''
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.threads)
+        best_move = self.search_moves(chessboard, pos_counts, ordered_moves[:1], 0, alpha, beta, side)
+        alpha = max(alpha, best_move[1])
+        if alpha >= beta or len(ordered_moves) == 1:
             return best_move
-        return total
+        jobs = [(self, chessboard, pos_counts, move, alpha, beta, np.random.randint(2**31)) for move in ordered_moves[1:]]
+        for move, (move_value, pv, nodes) in zip(ordered_moves[1:], self.pool.starmap(search_root_move, jobs)):
+            self.nodes += nodes
+            if move_value > best_move[1]:
+                best_move = (move, move_value)
+                self.pv_lines[0] = [move] + pv
+        return best_move
+
+    def search_child(self, new_board, pos_counts, depth, alpha, beta, side, first, reduced):
+        ''' Returns the value for side of new_board, the result of a move by side at depth. This is a principal variation search: only the first move at a node is searched with the full window. The rest are searched with a null window just above alpha, which is enough to show that they're no better, and searched again with the full window if they turn out to be better after all. If reduced, the null window search is also a ply shallower at first (a late move reduction).
+        Without a transposition table, a re-search can't reuse anything from the null window search before it, so every move is searched with the full window, other than the reduced search of a late move reduction.'''
+        if first or beta - alpha <= NULL_WINDOW or (self.table is None and not reduced):
+            return -self.alpha_beta(new_board, pos_counts, depth+1, -beta, -alpha, -side)[1]
+        move_value = -self.alpha_beta(new_board, pos_counts, depth+2 if reduced else depth+1, -alpha - NULL_WINDOW, -alpha, -side)[1]
+        if move_value > alpha and self.table is None:
+            return -self.alpha_beta(new_board, pos_counts, depth+1, -beta, -alpha, -side)[1]
+        if move_value > alpha and reduced:
+            move_value = -self.alpha_beta(new_board, pos_counts, depth+1, -alpha - NULL_WINDOW, -alpha, -side)[1]
+        # Inside the null window, the value is exact
+        if alpha + NULL_WINDOW <= move_value < beta:
+            move_value = -self.alpha_beta(new_board, pos_counts, depth+1, -beta, -alpha, -side)[1]
+        return move_value
+
+    def is_reducible(self, chessboard, move, depth):
+        '''Whether move is quiet enough for a late move reduction: not a capture, a promotion or a killer move'''
+        start, finish = move
+        piece = chessboard.squares[start[0]*8 + start[1]]
+        if (piece == board.WHITE_PAWN or piece == board.BLACK_PAWN) and (finish[0] == 0 or finish[0] == 7):
+            return False
+        return heuristic.mvv_lva(chessboard, move) is None and move not in self.killers[depth]
+
+    def search_moves(self, chessboard, pos_counts, ordered_moves, depth, alpha, beta, side, reduce_late=False):
+        ''' The negamax part of alpha_beta(): returns the best of the given
+        moves and its value, stopping early on a cutoff. Even if every move
+        loses, one of them is returned. If reduce_late, quiet moves after the
+        first few get a late move reduction (see search_child()).'''
+        best_move = (None, -100000)
+        for i, move in enumerate(ordered_moves):
+            new_board = board.make_move(chessboard, move[0], move[1])
+            pos_counts.push(new_board)
+            try:
+                reduced = reduce_late and i >= LMR_FULL_DEPTH_MOVES and self.is_reducible(chessboard, move, depth)
+                move_value = self.search_child(new_board, pos_counts, depth, alpha, beta, side, i == 0, reduced)
+            finally:
+                pos_counts.pop(new_board)
+            if self.noise:
+                move_value += np.random.normal(scale=0.05)
+            if move_value > best_move[1] or best_move[0] is None:
+                best_move = (move, move_value)
+                self.pv_lines[depth] = [move] + self.pv_lines[depth+1]
+            alpha = max(alpha, best_move[1])
+            if beta <= best_move[1]:
+                self.record_cutoff(chessboard, move, depth, side)
+                return best_move
+        return best_move
+
+def init_helper(stop):
+    global helper_stop
+    helper_stop = stop
+
+def helper_search(searcher, chessboard, pos_counts, helper, seed):
+    '''A Lazy SMP helper's search: searches chessboard iteratively deeper until the main search is done, with its own random seed and, on odd-numbered helpers, one ply deeper than the others at each step, so that the helpers don't all search the same tree in the same order. Nothing is returned but its node count; what it finds is passed on through the shared transposition table.'''
+    np.random.seed(seed)
+    searcher.stop = helper_stop
+    searcher.threads = 1
+    searcher.node_limit = 0
+    searcher.deadline = None
+    searcher.nodes = 0
+    searcher.pv_moves = {}
+    searcher.reset_ordering()
+    try:
+        for depth in range(1 + helper % 2, MAX_SEARCH_DEPTH+1):
+            searcher.search_depth = depth
+            searcher.pv_lines = [[] for i in range(depth+1)]
+            searcher.alpha_beta(chessboard, pos_counts, 0, -100000, 100000, searcher.side)
+    except SearchTimeout:
+        pass
+    return searcher.nodes
+
+def search_root_move(searcher, chessboard, pos_counts, move, alpha, beta, seed):
+    '''A root-split worker's job: searches move at the root of searcher's current search with the bounds alpha and beta, and returns its value for searcher's side, its principal variation and the number of nodes searched'''
+    np.random.seed(seed)
+    nodes_before = searcher.nodes
+    new_board = board.make_move(chessboard, move[0], move[1])
+    pos_counts.push(new_board)
+    move_value = -searcher.alpha_beta(new_board, pos_counts, 1, -beta, -alpha, -searcher.side)[1]
+    if searcher.noise:
+        move_value += np.random.normal(scale=0.05)
+    return move_value, searcher.pv_lines[1], searcher.nodes - nodes_before
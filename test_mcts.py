@@ -0,0 +1,136 @@
+'''
+Checks Tree.update_value(), which backs a rollout up in one pass up the tree,
+against the full recompute from every child that it replaced. Run with pytest.
+'''
+
+import random
+from collections import defaultdict
+
+import numpy as np
+
+import board
+import chess
+from mcts import MCTS, Tree
+from minimax import Minimax
+
+def reference_update(tree, values, visits, node, outcome, cur):
+    ''' The backup update_value() replaced: each node from node up to cur is
+    recomputed from all of its children. values and visits are kept apart from
+    the tree's own, by node number'''
+    while True:
+        visits[node] += 1
+        children = tree.children(node)
+        if len(children) == 0:
+            values[node] = outcome
+        else:
+            values[node] = sum(values[child]*visits[child] for child in children)
+        if node == cur or tree.parents[node] == Tree.NONE:
+            break
+        node = tree.parents[node]
+
+def check_against_reference(agent):
+    ''' Makes every update_value() call on agent's tree also run
+    reference_update(), and compares the two after each one '''
+    tree = agent.tree
+    values = defaultdict(float)
+    visits = defaultdict(int)
+    update_value = tree.update_value
+    def checked_update_value(node, outcome, cur):
+        update_value(node, outcome, cur)
+        reference_update(tree, values, visits, node, outcome, cur)
+        for n in range(tree.size):
+            assert tree.visits[n] == visits[n]
+            assert np.isclose(tree.values[n], values[n], rtol=1e-9, atol=1e-6)
+    tree.update_value = checked_update_value
+
+def below(tree, node):
+    ''' Returns node and all of the nodes under it '''
+    nodes = [node]
+    for n in nodes:
+        nodes.extend(tree.children(n))
+    return nodes
+
+def assert_consistent(tree, node, check_visits=True):
+    ''' Checks that each internal node at or under node has the visit-weighted
+    sum of its children's values, and that its visits are its children's, plus
+    one for its own rollout from when it was a leaf (except for the node
+    searched from, which was never rolled out itself) '''
+    for n in below(tree, node):
+        children = np.array(tree.children(n), dtype=np.int32)
+        if len(children) == 0:
+            continue
+        assert np.isclose(tree.values[n], np.dot(tree.values[children], tree.visits[children]), rtol=1e-9, atol=1e-6)
+        if check_visits:
+            assert tree.visits[n] - tree.visits[children].sum() in (0, 1)
+
+def play(agent, n_moves):
+    ''' Has agent search and play n_moves moves of a game, for both sides '''
+    chessboard = agent.cur_board
+    pos_counts = board.GameState()
+    pos_counts.push(chessboard)
+    for i in range(n_moves):
+        move = agent.get_move(chessboard, pos_counts)
+        chessboard = board.make_move(chessboard, *move)
+        agent.record_move(move)
+        pos_counts.push(chessboard)
+        assert_consistent(agent.tree, agent.cur)
+
+def test_update_value_matches_full_recompute():
+    random.seed(0)
+    agent = MCTS(1, 8, 100, 'normal', False, None, None, 0.5)
+    check_against_reference(agent)
+    play(agent, 4)
+
+def test_update_value_matches_full_recompute_with_heuristic():
+    random.seed(1)
+    agent = MCTS(1, 4, 100, 'normal', True, None, None, 0.5, 'bitboard')
+    check_against_reference(agent)
+    play(agent, 4)
+
+def test_refresh_values_brings_whole_tree_up_to_date():
+    random.seed(2)
+    agent = MCTS(1, 8, 100, 'normal', False, None, None, 0.5)
+    play(agent, 4)
+    agent.reset()
+    # Visits above the node searched from aren't counted, as they never were,
+    # so only the values are brought up to date
+    assert_consistent(agent.tree, Tree.ROOT, check_visits=False)
+
+def test_search_past_deadline_still_picks_a_move():
+    agent = MCTS(1, 8, 100, 'normal', False, None, None, 0.5, time_limit=1e-9)
+    pos_counts = board.GameState()
+    pos_counts.push(agent.cur_board)
+    move = agent.get_move(agent.cur_board, pos_counts)
+    assert move in board.get_all_moves(agent.cur_board, 1)
+
+def test_loaded_tree_grows_into_the_mapped_file(tmp_path):
+    random.seed(3)
+    agent = MCTS(1, 8, 200, 'normal', False, None, None, 0.5)
+    play(agent, 1)
+    path = str(tmp_path / 'tree')
+    agent.tree.save(path)
+    tree = Tree.load(path)
+    assert tree.size == agent.tree.size
+    assert np.array_equal(tree.visits[:tree.size], agent.tree.visits[:tree.size])
+    assert np.array_equal(tree.values[:tree.size], agent.tree.values[:tree.size])
+    agent.tree = tree
+    agent.cur_board = tree.root_board
+    agent.side = 1
+    agent.cur = Tree.ROOT
+    size = tree.size
+    play(agent, 1)
+    # New nodes went in the file's spare room rather than into copies of the
+    # arrays
+    assert tree.size > size
+    assert isinstance(tree.visits.base, memoryview)
+
+def test_second_game_as_player_2():
+    random.seed(4)
+    np.random.seed(4)
+    agent1 = Minimax(1, 1, 'normal')
+    agent2 = MCTS(1, 5, 20, 'normal', False, None, None, 0.5)
+    # As in chess.py's main(), the tree carries over to the next game
+    for game in range(2):
+        assert chess.play_game(agent1, agent2, None, 'normal', False) is not None
+        agent2.reset()
+        assert agent2.side == 1 and agent2.cur_board.squares == board.set_board('normal').squares
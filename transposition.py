@@ -0,0 +1,123 @@
+'''
+Fixed-size transposition table for Minimax. Entries are stored in preallocated
+numpy arrays, so the table's memory use is set once, up front. The arrays can
+live in shared memory, so that several processes search with the same table.
+'''
+
+from multiprocessing import shared_memory
+import weakref
+
+import numpy as np
+
+import board
+
+# Bound types: whether an entry's score is the position's exact value, or only
+# a lower or upper bound on it (from a beta or alpha cutoff)
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+NO_MOVE = -1
+
+# key (8) + depth (1) + bound (1) + score (8) + move (2)
+ENTRY_BYTES = 20
+# Order of the arrays in a shared table's buffer, widest first so that each
+# one is aligned
+ARRAYS = (('keys', np.uint64), ('scores', np.float64), ('moves', np.int16), ('depths', np.int8), ('bounds', np.int8))
+
+class TranspositionTable(object):
+    ''' Each bucket has two slots: the first keeps whichever entry was searched
+    deepest, and the second is always replaced. A lookup checks both.
+
+    If shared, the arrays are views of a multiprocessing.shared_memory block,
+    and a copy of the table pickled to another process attaches to the same
+    block. Processes read and write it without any locking: each slot's key
+    is stored XORed with the rest of its entry, so that an entry torn by two
+    processes writing it at once no longer matches its key, and just misses.'''
+
+    def __init__(self, size_mb=16, shared=False):
+        self.n_buckets = max(1, int(size_mb*2**20) // (2*ENTRY_BYTES))
+        self.shm = None
+        if shared:
+            self.shm = shared_memory.SharedMemory(create=True, size=2*self.n_buckets*ENTRY_BYTES)
+            # The block goes away once the process that made it is done with it
+            weakref.finalize(self, self.shm.unlink)
+            self.attach()
+        else:
+            n_entries = 2*self.n_buckets
+            self.keys = np.zeros(n_entries, dtype=np.uint64)
+            self.scores = np.zeros(n_entries, dtype=np.float64)
+            self.moves = np.zeros(n_entries, dtype=np.int16)
+            self.depths = np.zeros(n_entries, dtype=np.int8)
+            self.bounds = np.zeros(n_entries, dtype=np.int8)
+        self.score_bits = self.scores.view(np.uint64)
+        self.clear()
+
+    def attach(self):
+        offset = 0
+        for name, dtype in ARRAYS:
+            array = np.frombuffer(self.shm.buf, dtype=dtype, count=2*self.n_buckets, offset=offset)
+            setattr(self, name, array)
+            offset += array.nbytes
+
+    def __getstate__(self):
+        if self.shm is not None:
+            return {'n_buckets': self.n_buckets, 'shm_name': self.shm.name}
+        # score_bits has to be a view of the unpickled scores
+        state = self.__dict__.copy()
+        del state['score_bits']
+        return state
+
+    def __setstate__(self, state):
+        if 'shm_name' in state:
+            self.n_buckets = state['n_buckets']
+            self.shm = shared_memory.SharedMemory(name=state['shm_name'])
+            self.attach()
+        else:
+            self.__dict__.update(state)
+        self.score_bits = self.scores.view(np.uint64)
+
+    def __del__(self):
+        # The block can't be closed while the arrays still point into it
+        if self.shm is not None:
+            for name, dtype in ARRAYS:
+                delattr(self, name)
+            del self.score_bits
+            self.shm.close()
+
+    def clear(self):
+        self.keys[:] = 0
+        self.depths[:] = -1
+        self.moves[:] = NO_MOVE
+
+    def check(self, slot):
+        ''' The rest of the entry in slot, folded into 64 bits to XOR with its key'''
+        return int(self.score_bits[slot]) ^ (int(self.depths[slot]) & 0xff) ^ (int(self.bounds[slot]) << 8) ^ ((int(self.moves[slot]) & 0xffff) << 16)
+
+    def probe(self, key):
+        ''' Returns (depth, bound, score, move) for the given position key, or
+        None if the position isn't in the table'''
+        index = 2*(key % self.n_buckets)
+        for slot in (index, index+1):
+            if self.depths[slot] >= 0 and int(self.keys[slot]) ^ self.check(slot) == key:
+                move = int(self.moves[slot])
+                return (int(self.depths[slot]), int(self.bounds[slot]), float(self.scores[slot]),
+                        None if move == NO_MOVE else board.unpack_move(move))
+        return None
+
+    def store(self, key, depth, bound, score, move):
+        ''' depth is the number of plies searched below the position'''
+        index = 2*(key % self.n_buckets)
+        # Depth-preferred slot: keep the deeper search unless it's the same
+        # position being updated
+        if depth >= self.depths[index] or int(self.keys[index]) ^ self.check(index) == key:
+            slot = index
+        else:
+            slot = index+1
+        self.depths[slot] = depth
+        self.bounds[slot] = bound
+        self.scores[slot] = score
+        self.moves[slot] = NO_MOVE if move is None else board.pack_move(move)
+        # The key goes in last, so a reader can't match it to the rest of an
+        # older entry
+        self.keys[slot] = key ^ self.check(slot)